@@ -4,23 +4,38 @@
 #  Please check the LICENSE file for sharing or distribution permissions.      #
 # ##############################################################################
 """Define a generic alarm system."""
-from typing import Set
+import time
+from typing import Callable, List, Optional, Set
 
 import systemlogger
 
+from diagralhomekit.metrics import TriggerTiming
+
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "alarm", "application": "homekit"})
 
 
 class AlarmSystem:
     """Generic alarm system."""
 
+    # show the required state as soon as a command is accepted,
+    # then check it with confirm_groups()
+    optimistic_updates = False
+    # the active groups are trusted during this delay after their last update
+    groups_max_age_in_s = 30.0
+
     def __init__(self, name: str):
         """init function."""
         self.name = name
         self._active_groups: Set[int] = set()
-        self.is_triggered = False
+        # monotonic time of the last update of the active groups
+        self.groups_updated_at: Optional[float] = None
+        self._is_triggered = False
         self.trigger_date = None
-        self.status_fault = False
+        # timestamps of the email that triggered the alarm, until shown in Homekit
+        self.trigger_timing: Optional[TriggerTiming] = None
+        self._status_fault = False
+        # called each time the armed, triggered or fault state changes
+        self.listeners: List[Callable[[], None]] = []
 
     def extra_log_data(self, **kwargs):
         """Extra data for logging events."""
@@ -43,6 +58,42 @@ class AlarmSystem:
         """return the serial number of this system."""
         raise NotImplementedError
 
+    def add_listener(self, listener: Callable[[], None]):
+        """Call the listener each time the state of the system changes."""
+        self.listeners.append(listener)
+
+    def notify_change(self):
+        """Call all listeners."""
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.exception(e, extra=self.extra_log_data(action="notify"))
+
+    @property
+    def is_triggered(self) -> bool:
+        """return True if an alarm has been triggered."""
+        return self._is_triggered
+
+    @is_triggered.setter
+    def is_triggered(self, value: bool):
+        changed = self._is_triggered != value
+        self._is_triggered = value
+        if changed:
+            self.notify_change()
+
+    @property
+    def status_fault(self) -> bool:
+        """return True if a fault has been detected."""
+        return self._status_fault
+
+    @status_fault.setter
+    def status_fault(self, value: bool):
+        changed = self._status_fault != value
+        self._status_fault = value
+        if changed:
+            self.notify_change()
+
     def __str__(self):
         """Represent the object."""
         return f"{self.__class__.__name__}('{self.name}')"
@@ -53,14 +104,27 @@ class AlarmSystem:
 
     def set_active_groups(self, groups: Set[int]):
         """set the new current active groups."""
+        changed = self._active_groups != groups
         self._active_groups = groups
+        self.groups_updated_at = time.monotonic()
         if not groups:
-            self.is_triggered = False
+            changed = changed or self._is_triggered
+            self._is_triggered = False
+            self.trigger_timing = None
+        if changed:
+            self.notify_change()
 
     def get_active_groups(self) -> Set[int]:
         """return the currently active groups."""
         return self._active_groups
 
+    def has_fresh_groups(self) -> bool:
+        """return True if the active groups have been recently updated."""
+        return (
+            self.groups_updated_at is not None
+            and time.monotonic() < self.groups_updated_at + self.groups_max_age_in_s
+        )
+
     def get_stay_groups(self) -> Set[int]:
         """return the selected groups for stay configuration."""
         raise NotImplementedError
@@ -72,3 +136,7 @@ class AlarmSystem:
     def activate_groups(self, groups: Set[int]):
         """activate the selected groups."""
         raise NotImplementedError
+
+    def confirm_groups(self, groups: Set[int]) -> bool:
+        """check that the selected groups are actually active."""
+        return self.get_active_groups() == groups
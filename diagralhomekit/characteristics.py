@@ -0,0 +1,100 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file characteristics.py is part of DiagralHomekit.                     #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Update Homekit characteristics, sending all changes of a tick at once."""
+import threading
+from typing import Any, Dict, List, Tuple
+
+# noinspection PyPackageRequirements
+from pyhap.accessory import get_topic
+
+# noinspection PyPackageRequirements
+from pyhap.characteristic import IMMEDIATE_NOTIFY, Characteristic
+
+# noinspection PyPackageRequirements
+from pyhap.const import HAP_REPR_AID, HAP_REPR_IID, HAP_REPR_VALUE
+
+
+class CharacteristicUpdate:
+    """Set the values of many characteristics, notifying controllers once.
+
+    Unchanged values are skipped. Changed values are sent to the event loop of the
+    driver with a single callback, so the events of all accessories updated during
+    the same tick are grouped in the same encrypted message for each controller.
+
+    >>> from pyhap.characteristic import Characteristic
+    >>> char = Characteristic("StatusFault", "77", {"Format": "uint8"})
+    >>> with CharacteristicUpdate() as update:
+    ...     update.set(char, 1)
+    ...     update.set(char, 1)
+    True
+    False
+    >>> char.get_value()
+    1
+    """
+
+    def __init__(self):
+        """init function."""
+        self.changed: List[Characteristic] = []
+
+    def set(self, characteristic: Characteristic, value: Any) -> bool:
+        """Set a new value, returning True if it has changed."""
+        value = characteristic.to_valid_value(value)
+        characteristic.valid_value_or_raise(value)
+        if characteristic.value == value:
+            return False
+        characteristic.set_value(value, should_notify=False)
+        if characteristic not in self.changed:
+            self.changed.append(characteristic)
+        return True
+
+    def publish(self):
+        """Notify all changes."""
+        # events to send by driver
+        events: Dict[int, Tuple[Any, List[Tuple[str, dict]], bool]] = {}
+        for characteristic in self.changed:
+            accessory = characteristic.broker
+            if accessory is None:  # not yet added to an accessory
+                continue
+            driver = accessory.driver
+            data = {
+                HAP_REPR_AID: accessory.aid,
+                HAP_REPR_IID: accessory.iid_manager.get_iid(characteristic),
+                HAP_REPR_VALUE: characteristic.value,
+            }
+            topic = get_topic(data[HAP_REPR_AID], data[HAP_REPR_IID])
+            if topic not in driver.topics:  # no subscribed controller
+                continue
+            __, driver_events, immediate = events.get(id(driver), (driver, [], False))
+            driver_events.append((topic, data))
+            immediate = immediate or characteristic.type_id in IMMEDIATE_NOTIFY
+            events[id(driver)] = (driver, driver_events, immediate)
+        self.changed = []
+        for driver, driver_events, immediate in events.values():
+            if threading.current_thread() == driver.tid:
+                self.send_events(driver, driver_events, immediate)
+            else:
+                driver.loop.call_soon_threadsafe(
+                    self.send_events, driver, driver_events, immediate
+                )
+
+    @staticmethod
+    def send_events(driver, events: List[Tuple[str, dict]], immediate: bool):
+        """Send events from the event loop.
+
+        Events are queued by each connection, and the last one flushes the queue
+        when an immediate notification is required.
+        """
+        for index, (topic, data) in enumerate(events):
+            last = index == len(events) - 1
+            driver.async_send_event(topic, data, None, immediate and last)
+
+    def __enter__(self):
+        """Start a batch of updates."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Notify all changes, even after an error."""
+        self.publish()
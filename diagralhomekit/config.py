@@ -7,13 +7,17 @@
 import configparser
 import pathlib
 import re
+import time
+from typing import Optional
 
 import systemlogger
 
 from diagralhomekit.http_plugin import HttpMonitoringPlugin
 from diagralhomekit.meteofrance import MeteoFrancePlugin
+from diagralhomekit.metrics import ApiMetrics, MetricsRegistry
 from diagralhomekit.nut import UPSMonitoringPlugin
 from diagralhomekit.plex import PlexHomekitPlugin
+from diagralhomekit.scheduler import Scheduler
 
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
 
@@ -22,12 +26,20 @@ class HomekitConfig:
     """Diagral configuration, with multiple accounts."""
 
     max_request_tries = 3
+    scheduler_workers = 4
 
     def __init__(self):
         """init function."""
         from diagralhomekit.diagral import DiagralHomekitPlugin
 
         self.verbosity = False
+        self.config_dir: Optional[pathlib.Path] = None
+        # Prometheus values of all plugins
+        self.metrics = MetricsRegistry()
+        # calls to remote APIs, for all plugins
+        self.api_metrics = ApiMetrics(self.metrics)
+        # periodic work of all plugins
+        self.scheduler = Scheduler(max_workers=self.scheduler_workers)
         self.plugins = [
             DiagralHomekitPlugin(self),
             PlexHomekitPlugin(self),
@@ -38,6 +50,7 @@ class HomekitConfig:
 
     def load_config(self, config_file: pathlib.Path):
         """Load the configuration."""
+        self.config_dir = pathlib.Path(config_file).parent
         parser = configparser.ConfigParser()
         parser.read(config_file)
         config_errors = []
@@ -64,8 +77,14 @@ class HomekitConfig:
         """Run all daemons in separate threads."""
         for plugin in self.plugins:
             plugin.run_all()
+        self.scheduler.start()
 
-    def stop_all(self):
-        """Stop all accounts."""
+    def stop_all(self, timeout_in_s: float = 10.0):
+        """Stop all accounts, waiting for their threads until the timeout."""
+        end = time.monotonic() + timeout_in_s
         for plugin in self.plugins:
             plugin.stop_all()
+        self.scheduler.stop(timeout_in_s)
+        for plugin in self.plugins:
+            plugin.join_all(max(0.0, end - time.monotonic()))
+        self.metrics.flush()
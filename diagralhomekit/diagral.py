@@ -6,28 +6,46 @@
 """A Diagral config."""
 
 import configparser
+import contextlib
 import datetime
-import email.header
-import imaplib
 import io
-import re
+import json
+import os
+import pathlib
+import threading
 import time
-from multiprocessing.pool import ThreadPool
-from threading import Lock
+from threading import local
 from typing import Dict, Optional, Set, Tuple
 
 import requests
 import systemlogger
+from requests.adapters import HTTPAdapter
 from sentry_sdk import capture_exception
 
 from diagralhomekit.alarm_system import AlarmSystem
 from diagralhomekit.config import HomekitConfig
 from diagralhomekit.homekit_alarm import HomekitAlarm
+from diagralhomekit.imap import ImapMailbox
+from diagralhomekit.metrics import TriggerTiming
 from diagralhomekit.plugin import HomekitPlugin
+from diagralhomekit.ratelimit import (
+    PRIORITY_COMMAND,
+    PRIORITY_POLL,
+    PriorityLock,
+    TokenBucket,
+)
+from diagralhomekit.retry import CircuitBreaker, RetryableError, RetryPolicy
+from diagralhomekit.scheduler import ScheduledTask
+from diagralhomekit.smtp_receiver import SmtpReceiver
+from diagralhomekit.subjects import EVENT_ALARM, EVENT_INTRUSION, SubjectIndex
 from diagralhomekit.utils import (
+    BackoffInterval,
     RegexValidator,
+    RunningState,
     bool_validator,
     capture_some_exception,
+    get_email_timestamp,
+    parse_email_headers,
     slugify,
 )
 
@@ -58,6 +76,7 @@ class DiagralAlarmSystem(AlarmSystem):
         self.standalone: bool = False
         self.ttm_session_id: str = ""
         self.internal_name: str = "-"
+        self.last_full_status_update: Optional[float] = None
 
     @property
     def identifier(self) -> int:
@@ -77,64 +96,100 @@ class DiagralAlarmSystem(AlarmSystem):
         """return the selected groups for night configuration."""
         return {1}
 
-    def create_new_session(self, count=0):
-        """Create a new session."""
-        if count >= self.account.config.max_request_tries:
-            raise ValueError("Unable to get alarm status; please try again later.")
-        r = self.account.request(
-            "/authenticate/connect",
-            json_data={
-                "masterCode": "%04d" % self.master_code,
-                "transmitterId": self.transmitter_id,
-                "systemId": self.system_id,
-                "role": self.role,
-            },
-        )
-        try:
-            content = r.json()
-        except Exception as e:
-            capture_exception(e)
-            raise ValueError("Unable to connect to the system.")
-        if "ttmSessionId" in content:
-            self.ttm_session_id = content["ttmSessionId"]
-            self.set_active_groups(set(content["groups"]))
-            return self.ttm_session_id
-        message = content["message"]
-        if message == "transmitter.connection.badpincode":
-            raise ValueError("MasterCode invalid; please verify your configuration.")
-        elif message == "transmitter.connection.overlimit":
-            self.account.sleep_while_run(180, log=True)
-            return self.create_new_session(count=count + 1)
-        elif message == "transmitter.connection.sessionalreadyopen":
-            last_ttm_session_id = self.get_last_ttm_session_id()
-            self.disconnect_session(last_ttm_session_id)
-            return self.create_new_session(count=count + 1)
-        raise ValueError("Unable to create session; please verify your configuration.")
-
-    def get_central_status(self, count=0):
-        """Return the status for all systems."""
-        if count >= self.account.config.max_request_tries:
-            raise ValueError("Unable to get alarm status.")
+    def ensure_session(self):
+        """Create a new TTM session, unless a previous one can be reused."""
         if not self.ttm_session_id:
             self.create_new_session()
-        r = self.account.request(
-            "/configuration/getCentralStatusZone",
-            json_data={
-                "centralId": self.central_id,
-                "transmitterId": self.transmitter_id,
-                "systemId": self.system_id,
-                "ttmSessionId": self.ttm_session_id,
-            },
+
+    def invalidate_session(self):
+        """Forget the current TTM session, since it has been rejected."""
+        if self.ttm_session_id:
+            logger.info(
+                f"TTM session rejected for {self.name}.",
+                extra=self.extra_log_data(action="session"),
+            )
+        self.ttm_session_id = ""
+
+    def create_new_session(self):
+        """Create a new session."""
+
+        def connect():
+            r = self.account.request(
+                "/authenticate/connect",
+                json_data={
+                    "masterCode": "%04d" % self.master_code,
+                    "transmitterId": self.transmitter_id,
+                    "systemId": self.system_id,
+                    "role": self.role,
+                },
+            )
+            try:
+                content = r.json()
+            except Exception as e:
+                capture_exception(e)
+                raise ValueError("Unable to connect to the system.")
+            if "ttmSessionId" in content:
+                self.ttm_session_id = content["ttmSessionId"]
+                self.set_active_groups(set(content["groups"]))
+                return self.ttm_session_id
+            message = content["message"]
+            if message == "transmitter.connection.badpincode":
+                raise ValueError("MasterCode invalid; please verify your configuration.")
+            elif message == "transmitter.connection.overlimit":
+                raise RetryableError(
+                    "Too many connections to the system.",
+                    cooldown_in_s=self.account.overlimit_cooldown_in_s,
+                )
+            elif message == "transmitter.connection.sessionalreadyopen":
+                last_ttm_session_id = self.get_last_ttm_session_id()
+                self.disconnect_session(last_ttm_session_id)
+                raise RetryableError("A session was already open.", immediate=True)
+            raise ValueError(
+                "Unable to create session; please verify your configuration."
+            )
+
+        return self.account.call_with_retry(
+            connect, "Unable to get alarm status; please try again later."
         )
-        if r.status_code != 200:
-            self.account.sleep_while_run(10, log=True)
-            return self.get_central_status(count + 1)
-        return r.json()
+
+    def get_central_status(self):
+        """Return the status for all systems."""
+
+        def get_status():
+            if not self.ttm_session_id:
+                self.create_new_session()
+            r = self.account.request(
+                "/configuration/getCentralStatusZone",
+                json_data={
+                    "centralId": self.central_id,
+                    "transmitterId": self.transmitter_id,
+                    "systemId": self.system_id,
+                    "ttmSessionId": self.ttm_session_id,
+                },
+            )
+            if r.status_code != 200:
+                self.invalidate_session()
+                raise RetryableError(f"Invalid central status ({r.status_code}).")
+            return r.json()
+
+        return self.account.call_with_retry(get_status, "Unable to get alarm status.")
+
+    def is_full_status_due(self, interval_in_s: int) -> bool:
+        """Return True if the complete status must be fetched again."""
+        if self.last_full_status_update is None:
+            return True
+        return time.monotonic() >= self.last_full_status_update + interval_in_s
+
+    def update_full_status(self):
+        """Fetch the complete status and look for faults."""
+        status = self.get_central_status()
+        self.analyze_central_status(status)
+        self.last_full_status_update = time.monotonic()
 
     def analyze_central_status(self, data):
         """Analyze the result provided by get_central_status(), looking for faults."""
         had_fault = self.status_fault
-        self.status_fault = False
+        status_fault = False
         for category, v in data.items():
             if not category.endswith("Status"):
                 continue
@@ -142,14 +197,15 @@ class DiagralAlarmSystem(AlarmSystem):
                 v = [v]
             for sub_data in v:
                 for alert_type, state in sub_data.items():
-                    if alert_type.endswith("Alert") and state and not had_fault:
-                        self.status_fault = True
+                    if not alert_type.endswith("Alert") or not state:
+                        continue
+                    status_fault = True
+                    if not had_fault:
                         extra = self.extra_log_data(action="fault")
                         msg = f"Set new {alert_type} in {category} for {self.name}."
-                        logger.warning(
-                            msg,
-                            extra=extra,
-                        )
+                        logger.warning(msg, extra=extra)
+        # a single change event for all alerts
+        self.status_fault = status_fault
         if had_fault and not self.status_fault:
             msg = f"Fault status cleared for {self.name}."
             logger.warning(msg, extra=self.extra_log_data(action="fault"))
@@ -158,7 +214,7 @@ class DiagralAlarmSystem(AlarmSystem):
         """Disconnect the current session."""
         if session is None:
             session = self.ttm_session_id
-        if session is None:
+        if not session:
             return
         r = self.account.request(
             "/authenticate/disconnect",
@@ -172,7 +228,8 @@ class DiagralAlarmSystem(AlarmSystem):
         content = r.json()
         if content["status"] != "OK":
             raise ValueError("Disconnect Failed: %r" % content)
-        self.ttm_session_id = None
+        if session == self.ttm_session_id:
+            self.ttm_session_id = ""
 
     def get_last_ttm_session_id(self) -> Optional[str]:
         """Get the last TTM session id."""
@@ -183,89 +240,138 @@ class DiagralAlarmSystem(AlarmSystem):
             return r.text
         return None
 
-    def update_status(self, count=0):
+    def update_status(self):
         """Update the internal status."""
-        if count >= self.account.config.max_request_tries:
-            raise ValueError("Unable to get alarm status.")
-        if not self.ttm_session_id:
-            self.create_new_session()
-            return
-        r = self.account.request(
-            "/status/getSystemState",
-            json_data={
-                "centralId": self.central_id,
-                "ttmSessionId": self.ttm_session_id,
-            },
-        )
-        if r.status_code != 200:
-            self.account.sleep_while_run(10, log=True)
-            return self.update_status(count + 1)
-        content = r.json()
-        self.set_active_groups(set(content["groups"]))
+
+        def get_state():
+            if not self.ttm_session_id:
+                self.create_new_session()
+                return
+            r = self.account.request(
+                "/status/getSystemState",
+                json_data={
+                    "centralId": self.central_id,
+                    "ttmSessionId": self.ttm_session_id,
+                },
+            )
+            if r.status_code != 200:
+                self.invalidate_session()
+                raise RetryableError(f"Invalid system state ({r.status_code}).")
+            content = r.json()
+            self.set_active_groups(set(content["groups"]))
+
+        self.account.call_with_retry(get_state, "Unable to get alarm status.")
+
+    @property
+    def optimistic_updates(self) -> bool:
+        """Show the required state as soon as a command is accepted.
+
+        Otherwise, the state is only shown once returned by the next poll.
+        """
+        return self.account.optimistic_updates
 
     def activate_groups(self, groups: Set[int]):
         """Activate some groups."""
         self.account.change_alarm_state(self, groups)
 
-    def send_activation_command(self, groups: Set[int], count=0):
+    def confirm_groups(self, groups: Set[int]) -> bool:
+        """Check that the selected groups are actually active."""
+        return self.account.confirm_alarm_state(self, groups)
+
+    def send_activation_command(self, groups: Set[int]):
         """Activate some groups (internal function)."""
         if not groups:
             return self.deactivate_alarm()
-        if count >= self.account.config.max_request_tries:
-            raise ValueError("Unable to send activation command.")
-        if not self.ttm_session_id:
-            self.create_new_session()
         if len(groups) == 4:
             state = "on"
             groups_l = []
         else:
             state = "group"
             groups_l = list(groups)
-        r = self.account.request(
-            "/action/stateCommand",
-            json_data={
-                "systemState": state,
-                "group": groups_l,
-                "currentGroup": [],
-                "nbGroups": "4",
-                "ttmSessionId": self.ttm_session_id,
-            },
-        )
-        if r.status_code != 200:
-            self.account.sleep_while_run(10, log=True)
-            return self.send_activation_command(groups=groups, count=count + 1)
-        content = r.json()
-        if content["commandStatus"] != "CMD_OK":
-            raise ValueError("Error during activation.")
-        self.set_active_groups(set(content["groups"]))
 
-    def deactivate_alarm(self, count=0):
+        def activate():
+            if not self.ttm_session_id:
+                self.create_new_session()
+            r = self.account.request(
+                "/action/stateCommand",
+                json_data={
+                    "systemState": state,
+                    "group": groups_l,
+                    "currentGroup": [],
+                    "nbGroups": "4",
+                    "ttmSessionId": self.ttm_session_id,
+                },
+            )
+            if r.status_code != 200:
+                self.invalidate_session()
+                raise RetryableError(f"Activation command failed ({r.status_code}).")
+            content = r.json()
+            if content["commandStatus"] != "CMD_OK":
+                raise ValueError("Error during activation.")
+            if self.optimistic_updates:
+                self.set_active_groups(set(content["groups"]))
+
+        self.account.call_with_retry(activate, "Unable to send activation command.")
+
+    def deactivate_alarm(self):
         """Deactivate the alarm."""
-        if count >= self.account.config.max_request_tries:
-            raise ValueError("Unable to request alarm deactivation.")
-        if not self.ttm_session_id:
-            self.create_new_session()
-        r = self.account.request(
-            "/action/stateCommand",
-            json_data={
-                "systemState": "off",
-                "group": [],
-                "currentGroup": [],
-                "nbGroups": "4",
-                "ttmSessionId": self.ttm_session_id,
-            },
+
+        def deactivate():
+            if not self.ttm_session_id:
+                self.create_new_session()
+            r = self.account.request(
+                "/action/stateCommand",
+                json_data={
+                    "systemState": "off",
+                    "group": [],
+                    "currentGroup": [],
+                    "nbGroups": "4",
+                    "ttmSessionId": self.ttm_session_id,
+                },
+            )
+            if r.status_code != 200:
+                self.invalidate_session()
+                raise RetryableError(f"Deactivation command failed ({r.status_code}).")
+            content = r.json()
+            if content["commandStatus"] != "CMD_OK":
+                raise ValueError("Unable to complete deactivation.")
+            if self.optimistic_updates:
+                self.set_active_groups(set(content["groups"]))
+
+        self.account.call_with_retry(
+            deactivate, "Unable to request alarm deactivation."
         )
-        if r.status_code != 200:
-            self.account.sleep_while_run(10, log=True)
-            return self.deactivate_alarm(count=count + 1)
-        content = r.json()
-        if content["commandStatus"] != "CMD_OK":
-            raise ValueError("Unable to complete deactivation.")
 
 
 class DiagralAccount:
     """Represent a Diagral account."""
 
+    # the API refuses new connections for a while when there are too many of them
+    overlimit_cooldown_in_s = 180
+    # a new state is checked a few times after each command
+    confirmation_tries = 3
+    confirmation_interval_in_s = 3
+
+    # the polling stays fast for this duration after a command or an alarm email
+    activity_duration_in_s = 300
+
+    # used when the login response does not provide any expiry
+    session_lifetime_in_s = 3600
+    # the session is refreshed a bit before its actual expiry
+    session_refresh_margin_in_s = 300
+
+    http_headers = {
+        "User-Agent": "eOne/1.12.1.2 CFNetwork/1333.0.4 Darwin/21.5.0"
+        "WebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+        "Accept": "application/json, text/plain, */*",
+        "Accept-Encoding": "deflate",
+        "X-App-Version": "1.9.1",
+        "X-Identity-Provider": "JANRAIN",
+        "ttmSessionIdNotRequired": "true",
+        "X-Vendor": "diagral",
+        "Content-Type": "application/json;charset=UTF-8",
+    }
+
     def __init__(self, config, login: str, password: str):
         """init function."""
         self.config: HomekitConfig = config
@@ -273,7 +379,22 @@ class DiagralAccount:
         self.password = password
         self.alarm_systems: Dict[int, DiagralAlarmSystem] = {}
         self.session_id = None
+        self.session_expiry: Optional[float] = None
+        self.session_persist = False
+        self.keep_ttm_session = True
+        self.optimistic_updates = True
         self.diagral_id = None
+        # the armed state is cheaply fetched every poll_min_interval while something
+        # happens, backing off to poll_max_interval while idle;
+        # the complete status (with faults) is only fetched every full_status_interval
+        self.poll_min_interval = 10
+        self.poll_max_interval = 300
+        self.full_status_interval = 600
+        self.poll_interval: Optional[BackoffInterval] = None
+        # delay before trying again a failed initialization (like a wrong password)
+        self.init_interval: Optional[BackoffInterval] = None
+        self.next_status_update = 0.0
+        self.last_activity: Optional[float] = None
 
         self.imap_login = ""
         self.imap_password = None
@@ -281,9 +402,38 @@ class DiagralAccount:
         self.imap_port = 993
         self.imap_use_tls = True
         self.imap_directory = "INBOX"
+        self.imap_archive_directory = ""
+        self.imap_mailbox: Optional[ImapMailbox] = None
+        # alarm emails can also be forwarded by a local MTA to a SMTP/LMTP listener
+        self.smtp_address = "127.0.0.1"
+        self.smtp_port = 0
+        self.smtp_lmtp = False
+        self.subject_index: Optional[SubjectIndex[DiagralAlarmSystem]] = None
 
-        self.request_lock = Lock()
-        self.is_running = True
+        self.http_pool_size = 2
+        self.http_connect_timeout = 10.0
+        self.http_read_timeout = 60.0
+        self.http_session: Optional[requests.Session] = None
+        self.http_session_token = None
+
+        # at most api_budget requests every api_budget_window seconds
+        self.api_budget = 600
+        self.api_budget_window = 3600
+        self.rate_limiter: Optional[TokenBucket] = None
+        self.request_priority = local()
+        # the last requested endpoint is the one tried again after an error
+        self.last_endpoint = local()
+        self.retry_policy = RetryPolicy(max_tries=config.max_request_tries)
+        self.circuit_breaker = CircuitBreaker(f"Diagral API for {login}")
+
+        # commands are sent before any pending background request
+        self.request_lock = PriorityLock()
+        self.running = RunningState()
+        self.is_initialized = False
+        # updates of the systems are run by the shared scheduler
+        self.poll_task: Optional[ScheduledTask] = None
+        # IMAP IDLE keeps a connection waiting, so emails are checked in a thread
+        self.email_thread: Optional[threading.Thread] = None
         self.show_mockup_requests = False
 
     def __str__(self):
@@ -314,33 +464,132 @@ class DiagralAccount:
             self.alarm_systems[system_id] = DiagralAlarmSystem(
                 self, system_id, **kwargs
             )
+            self.subject_index = None
         return self.alarm_systems[system_id]
 
-    def request(self, endpoint, json_data=None, method="POST"):
-        """Perform a request."""
-        headers = {
-            "User-Agent": "eOne/1.12.1.2 CFNetwork/1333.0.4 Darwin/21.5.0"
-            "WebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Encoding": "deflate",
-            "X-App-Version": "1.9.1",
-            "X-Identity-Provider": "JANRAIN",
-            "ttmSessionIdNotRequired": "true",
-            "X-Vendor": "diagral",
-            "Content-Type": "application/json;charset=UTF-8",
-        }
-        if endpoint != "/authenticate/login":
-            headers["Authorization"] = f"Bearer {self.session_id}"
-            headers["X-Identity-Provider"] = "JANRAIN"
-            headers["ttmSessionIdNotRequired"] = "true"
-        url = f"https://appv3.tt-monitor.com/topaze{endpoint}"
-        r = requests.request(
-            method.lower(),
-            url,
-            json=json_data,
-            headers=headers,
-            timeout=60,
+    def get_http_session(self) -> requests.Session:
+        """Return the pooled HTTP session, creating it on first use."""
+        if self.http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.http_pool_size
+            )
+            session.mount("https://", adapter)
+            session.headers.update(self.http_headers)
+            self.http_session = session
+            self.http_session_token = None
+        return self.http_session
+
+    def close_http_session(self):
+        """Close all pooled connections."""
+        if self.http_session is not None:
+            self.http_session.close()
+            self.http_session = None
+
+    def call_with_retry(self, func, error_message: str):
+        """Call the function, retrying it on temporary errors."""
+        return self.retry_policy.call(
+            func,
+            sleep=self.sleep_while_run,
+            breaker=self.circuit_breaker,
+            error_message=error_message,
+            on_retry=self.record_retry,
         )
+
+    def record_retry(self):
+        """Count a new try of the last requested endpoint."""
+        endpoint = getattr(self.last_endpoint, "value", "")
+        self.config.api_metrics.record_retry("diagral", self.login, endpoint)
+
+    def wait_for_budget(self, delay_in_s: float):
+        """Wait for the API budget, letting commands take the request lock meanwhile."""
+        with self.request_lock.released():
+            self.sleep_while_run(delay_in_s, log=True)
+
+    @property
+    def api_reserve(self) -> int:
+        """Return the part of the API budget kept for the commands."""
+        return max(1, self.api_budget // 10)
+
+    def get_rate_limiter(self) -> TokenBucket:
+        """Return the rate limiter, creating it on first use."""
+        if self.rate_limiter is None:
+            self.rate_limiter = TokenBucket(
+                self.api_budget, self.api_budget_window, reserve=self.api_reserve
+            )
+        return self.rate_limiter
+
+    @contextlib.contextmanager
+    def command_priority(self):
+        """Requests made in this context are user commands, not background polls."""
+        previous = getattr(self.request_priority, "value", PRIORITY_POLL)
+        self.request_priority.value = PRIORITY_COMMAND
+        try:
+            yield
+        finally:
+            self.request_priority.value = previous
+
+    def request(self, endpoint, json_data=None, method="POST", relogin=True):
+        """Perform a request.
+
+        When the session is rejected, a new login is made and the request is sent
+        again, only once: a second rejection is returned unchanged.
+        """
+        self.circuit_breaker.check()
+        priority = getattr(self.request_priority, "value", PRIORITY_POLL)
+        if not self.get_rate_limiter().acquire(
+            endpoint,
+            priority=priority,
+            sleep=self.wait_for_budget,
+            is_running=lambda: self.is_running,
+        ):
+            raise ValueError("Stopped while waiting for the API budget.")
+        # commands received during the wait go first
+        self.request_lock.yield_if_needed()
+        session = self.get_http_session()
+        if self.http_session_token != self.session_id:
+            # headers are only rebuilt when the bearer token changes
+            session.headers["Authorization"] = f"Bearer {self.session_id}"
+            self.http_session_token = self.session_id
+        headers = None
+        if endpoint == "/authenticate/login":
+            headers = {"Authorization": None}
+        url = f"https://appv3.tt-monitor.com/topaze{endpoint}"
+        self.last_endpoint.value = endpoint
+        api_metrics = self.config.api_metrics
+        try:
+            with api_metrics.measure("diagral", self.login, endpoint) as call:
+                r = session.request(
+                    method.lower(),
+                    url,
+                    json=json_data,
+                    headers=headers,
+                    timeout=(self.http_connect_timeout, self.http_read_timeout),
+                )
+                call.status = r.status_code
+        except requests.exceptions.RequestException:
+            self.circuit_breaker.record_failure()
+            raise
+        if r.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        if (
+            r.status_code == 401
+            and relogin
+            and self.session_id
+            and endpoint not in {"/authenticate/login", "/authenticate/logout"}
+        ):
+            logger.info(
+                "Diagral session rejected, login again.",
+                extra=self.extra_log_data(action="session"),
+            )
+            self.session_id = None
+            if self.do_login():
+                api_metrics.record_retry("diagral", self.login, endpoint)
+                return self.request(
+                    endpoint, json_data=json_data, method=method, relogin=False
+                )
         if self.config.verbosity >= 4:
             logger.debug(
                 f"{url}: {r.status_code}",
@@ -369,12 +618,20 @@ class DiagralAccount:
         if r.status_code == 200:
             content = r.json()
             self.session_id = content["sessionId"]
+            expires_in_ms = content.get("expiresIn") or (
+                self.session_lifetime_in_s * 1000
+            )
+            self.session_expiry = time.time() + expires_in_ms / 1000
+            self.save_session()
             return True
         return False
 
     def do_logout(self):
         """Logout from the server."""
         r = self.request("/authenticate/logout", json_data={"systemId": "null"})
+        self.session_id = None
+        self.session_expiry = None
+        self.save_session()
         if r.status_code == 401:
             return
         if r.status_code != 200:
@@ -383,6 +640,75 @@ class DiagralAccount:
         if content["status"] != "OK":
             raise ValueError("Logout failed.")
 
+    def is_session_valid(self) -> bool:
+        """Return True if the current session can still be used."""
+        return bool(
+            self.session_id
+            and self.session_expiry
+            and time.time() < self.session_expiry - self.session_refresh_margin_in_s
+        )
+
+    def ensure_login(self):
+        """Login to the server, unless the current session is still valid."""
+        if self.session_id is None:
+            self.load_session()
+        if self.is_session_valid():
+            return
+        if not self.do_login():
+            raise ValueError("Unable to login; please verify your configuration.")
+
+    def end_session(self):
+        """Logout from the server, unless the session must survive a restart."""
+        if self.session_id is None:
+            return
+        for system in self.alarm_systems.values():
+            try:
+                system.disconnect_session()
+            except ValueError as e:
+                logger.warning(f"{e}", extra=system.extra_log_data(action="session"))
+        if not self.session_persist:
+            self.do_logout()
+
+    @property
+    def session_filename(self) -> Optional[pathlib.Path]:
+        """Return the file used for persisting the session."""
+        if not self.session_persist or self.config.config_dir is None:
+            return None
+        return self.config.config_dir / f"diagral-session-{slugify(self.login)}.json"
+
+    def load_session(self):
+        """Load the persisted session, if any."""
+        filename = self.session_filename
+        if filename is None or not filename.is_file():
+            return
+        try:
+            with open(filename) as fd:
+                content = json.load(fd)
+            self.session_id = content["session_id"]
+            self.session_expiry = content["session_expiry"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(
+                f"Unable to load the Diagral session from {filename}: {e}",
+                extra=self.extra_log_data(action="session"),
+            )
+
+    def save_session(self):
+        """Persist the current session, if required."""
+        filename = self.session_filename
+        if filename is None:
+            return
+        content = {"session_id": self.session_id, "session_expiry": self.session_expiry}
+        try:
+            # the session token is a credential: keep it private
+            fileno = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fileno, "w") as fd:
+                json.dump(content, fd)
+        except OSError as e:
+            logger.warning(
+                f"Unable to save the Diagral session to {filename}: {e}",
+                extra=self.extra_log_data(action="session"),
+            )
+
     def initialize_systems(self):
         """Initialize all systems for getting their internal names."""
         r = self.request("/configuration/getSystems", json_data={})
@@ -405,189 +731,316 @@ class DiagralAccount:
                 system.internal_name = system_data["name"]
                 system.installation_complete = system_data["installationComplete"]
                 system.standalone = system_data["standalone"]
+        self.subject_index = None
         return content["systems"]
 
-    def check_alarm_emails(self, check_count=10, check_interval_in_s=5):
-        """Check for new emails."""
+    def get_mailbox(self) -> Optional[ImapMailbox]:
+        """Return the IMAP mailbox receiving alarm emails, if any.
+
+        The connection is kept between two checks and is shared with all other
+        accounts using the same mailbox.
+        """
         if not self.imap_login or not self.imap_hostname:
+            return None
+        if self.imap_mailbox is None:
+            self.imap_mailbox = ImapMailbox.get_mailbox(
+                self.imap_hostname,
+                self.imap_port,
+                self.imap_login,
+                self.imap_password,
+                use_tls=self.imap_use_tls,
+                directory=self.imap_directory,
+                archive_directory=self.imap_archive_directory,
+            )
+            self.imap_mailbox.subscribe(self.analyze_email)
+        return self.imap_mailbox
+
+    def close_mailbox(self):
+        """Stop receiving alarm emails, closing the connection if it is not shared."""
+        if self.imap_mailbox is not None:
+            self.imap_mailbox.unsubscribe(self.analyze_email)
+            self.imap_mailbox = None
+
+    def check_alarm_emails(self, check_interval_in_s: int = 60):
+        """Check for new emails, then wait for the next ones.
+
+        When the mailbox is already checked by another account, new emails are also
+        given to this account, so it only has to wait.
+        """
+        mailbox = self.get_mailbox()
+        if mailbox is None or not mailbox.is_available:
+            self.sleep_while_run(check_interval_in_s)
             return
-        logger.debug(
-            f"Connect to {self.imap_login}@{self.imap_hostname}:{self.imap_port}",
-            extra=self.extra_log_data(action="imap", detail="connect"),
-        )
-        cls = imaplib.IMAP4_SSL if self.imap_use_tls else imaplib.IMAP4
+        if not mailbox.lock.acquire(blocking=False):
+            self.sleep_while_run(check_interval_in_s)
+            return
+        try:
+            mailbox.check(verbose=self.config.verbosity >= 4)
+            if mailbox.supports_idle():
+                self.wait_for_emails(mailbox, check_interval_in_s)
+            else:
+                self.sleep_while_run(check_interval_in_s)
+        finally:
+            mailbox.lock.release()
 
-        with cls(self.imap_hostname, self.imap_port) as imap_client:
-            if not self.imap_use_tls:
-                try:
-                    imap_client.starttls()
-                except imaplib.IMAP4.error:
-                    pass
-            imap_client.login(self.imap_login, self.imap_password)
-            typ, data = imap_client.select(mailbox=self.imap_directory, readonly=False)
-            if typ != "OK":
-                raise ValueError(f"Invalid mailbox {self.imap_directory}")
-            to_expunge = False
-            index = 0
-            while index < check_count and self.is_running:
-                to_expunge = self._perform_imap_search(imap_client) or to_expunge
+    def wait_for_emails(self, mailbox: ImapMailbox, interval_in_s: int):
+        """Wait for new emails with IMAP IDLE."""
+        if interval_in_s <= 0:
+            return
+        if mailbox.idle(interval_in_s, is_running=lambda: self.is_running):
+            logger.debug(
+                f"New email in {mailbox}",
+                extra=self.extra_log_data(action="imap", detail="idle"),
+            )
+
+    def watch_emails(self):
+        """Continuously check for alarm emails."""
+        extra = self.extra_log_data()
+        check_interval_in_s = 60
+        while self.is_running:
+            logger.debug(f"Check emails for system {self.login}", extra=extra)
+            try:
+                self.check_alarm_emails(check_interval_in_s=check_interval_in_s)
+            except Exception as e:
+                logger.exception(e, extra=extra)
+                capture_some_exception(e)
                 self.sleep_while_run(check_interval_in_s)
-                index += 1
-            if to_expunge:
-                if self.config.verbosity >= 4:
-                    logger.debug(
-                        f"Apply IMAP commands to {self.imap_login}@{self.imap_hostname}:{self.imap_port}",
-                        extra=self.extra_log_data(action="imap", detail="apply"),
-                    )
-                imap_client.expunge()
+        self.close_mailbox()
+
+    @property
+    def is_running(self) -> bool:
+        """Return True until the account is stopped."""
+        return self.running.is_running
 
-    def sleep_while_run(self, interval_in_s: int, log: bool = False):
-        """Sleep for the given interval if active."""
+    @is_running.setter
+    def is_running(self, value: bool):
+        if value:
+            self.running.start()
+        else:
+            self.running.stop()
+
+    def sleep_while_run(self, interval_in_s: float, log: bool = False):
+        """Sleep for the given interval, returning at once when stopped."""
         if log:
             logger.info(
                 "Sleeping for %d seconds",
                 interval_in_s,
-                self.extra_log_data(action="sleep"),
+                extra=self.extra_log_data(action="sleep"),
             )
-        for __ in range(interval_in_s * 10):
-            if not self.is_running:
-                return
-            time.sleep(0.1)
+        self.running.wait(interval_in_s)
 
-    def _perform_imap_search(self, imap_client):
-        """Perform an IMAP search to check for alarm emails."""
-        if self.config.verbosity >= 4:
-            logger.debug(
-                f"Search in {self.imap_login}@{self.imap_hostname}:{self.imap_port}",
-                extra=self.extra_log_data(action="imap", detail="search"),
-            )
-        typ, data = imap_client.search(None, "NOT DELETED")
-        if typ != "OK":
-            raise ValueError("Unable to perform an IMAP search for new messages.")
-        max_document_size = 100000
-        to_expunge = False
-        # noinspection PyUnresolvedReferences
-        for message_num in data[0].decode().split():
-            typ, data = imap_client.fetch(message_num, "(RFC822.SIZE)")
-            # noinspection PyUnresolvedReferences
-            id_size = data[0].decode()
-            matcher = re.match(r".+ \(RFC822.SIZE (\d+)\)$", id_size)
-            if not matcher or typ != "OK":
-                logger.warning(
-                    f"unable to fetch the size of message {message_num}",
-                    extra=self.extra_log_data(action="imap", detail="found"),
-                )
-                continue
-            message_size = int(matcher.group(1))
-            if message_size <= max_document_size:
-                typ, data = imap_client.fetch(message_num, "(RFC822)")
-                if typ != "OK":
-                    # noinspection PyUnresolvedReferences
-                    text = data[0].decode() if data and data[0] else "unknown error"
-                    logger.warning(
-                        f"unable to fetch message {message_num} ({text})",
-                        extra=self.extra_log_data(action="imap", detail="found"),
-                    )
-                    continue
-                # noinspection PyUnresolvedReferences
-                message_text = data[0][1].decode()
-                logger.debug(
-                    f"Fetch email from {self.imap_login}@{self.imap_hostname}:{self.imap_port}",
-                    extra=self.extra_log_data(action="imap", detail="found"),
-                )
-                self._analyze_single_email(message_text)
-            logger.debug(
-                f"Delete email {message_num} from {self.imap_login}@{self.imap_hostname}:{self.imap_port}",
-                extra=self.extra_log_data(action="imap", detail="delete"),
+    def get_subject_index(self) -> SubjectIndex[DiagralAlarmSystem]:
+        """Return the index mapping email subjects to the systems."""
+        if self.subject_index is None:
+            self.subject_index = SubjectIndex(
+                (system.internal_name, system) for system in self.alarm_systems.values()
             )
-            imap_client.store(message_num, "+FLAGS", r"(\Deleted)")
-            to_expunge = True
-        return to_expunge
-
-    def _analyze_single_email(self, content: str):
-        """Look for emails to check if an alarm is set."""
-        line = ""
+        return self.subject_index
 
-        def decode(x, y):
-            if isinstance(x, str):
-                return x
-            return x.decode(y or "utf-8")
+    def analyze_email(self, header: bytes, received_at: Optional[float] = None):
+        """Look for emails to check if an alarm is set.
 
-        for line in content.splitlines():
-            if not line.startswith("Subject:"):
-                continue
-            line = "".join(decode(x, y) for (x, y) in email.header.decode_header(line))
-            break
+        Called with the headers of each email received by IMAP or by SMTP.
+        """
+        if received_at is None:
+            received_at = time.time()
+        message = parse_email_headers(header)
+        line = str(message.get("Subject", ""))
         logger.debug(
-            f"Found subject {line} in email to {self.imap_login}",
+            f"Found subject {line} in email to {self.login}",
             extra=self.extra_log_data(action="imap", detail="subject"),
         )
-
-        for system in self.alarm_systems.values():
-            name = system.internal_name
-            if name.startswith("* "):
-                name = name[2:]
-            if line.endswith(name + " : Alarme"):
-                logger.debug(
-                    f"Alarm triggered for {system.name}.",
-                    extra=self.extra_log_data(action="imap", detail="alarm"),
-                )
+        result = self.get_subject_index().classify(line)
+        if result is None:
+            return
+        event, systems = result
+        for system in systems:
+            logger.debug(
+                f"Event {event} for {system.name}.",
+                extra=self.extra_log_data(action="imap", detail=event),
+            )
+            if event in (EVENT_ALARM, EVENT_INTRUSION):
+                if not system.is_triggered:
+                    system.trigger_timing = TriggerTiming(
+                        get_email_timestamp(message), received_at, time.time()
+                    )
                 system.is_triggered = True
                 system.trigger_date = datetime.datetime.now(tz=datetime.timezone.utc)
+            else:
+                # shown until the next complete status, that is requested right now
+                system.status_fault = True
+                system.last_full_status_update = None
+            self.notify_activity()
 
     def update_all_systems(self):
-        """Update all system with a few requests."""
+        """Update all system with a few requests.
+
+        The complete status is only requested when it is outdated or when the armed
+        state has changed since the previous update.
+        """
         with self.request_lock:
-            self.do_login()
+            self.ensure_login()
             for system in self.alarm_systems.values():
                 try:
-                    system.create_new_session()
-                    status = system.get_central_status()
-                    system.analyze_central_status(status)
-                    system.disconnect_session()
+                    previous_groups = system.get_active_groups()
+                    system.ensure_session()
+                    system.update_status()
+                    if (
+                        system.get_active_groups() != previous_groups
+                        or system.is_full_status_due(self.full_status_interval)
+                    ):
+                        system.update_full_status()
+                    if not self.keep_ttm_session:
+                        system.disconnect_session()
                 except Exception as e:
                     logger.exception(e, extra=system.extra_log_data())
                     capture_some_exception(e)
-                    self.sleep_while_run(5, log=True)
-            self.do_logout()
-        self.sleep_while_run(1)
 
-    def change_alarm_state(self, system: DiagralAlarmSystem, groups: Set[int]):
-        """Change the alarm state."""
-        extra = self.extra_log_data(action="alarm_state")
-        logger.info(f"Change alarm state of {system.name} to {groups}", extra=extra)
-        with self.request_lock:
-            self.do_login()
-            system.create_new_session()
-            system.send_activation_command(groups)
-            system.disconnect_session()
-            self.do_logout()
-        time.sleep(1)
+    def notify_activity(self):
+        """Poll the systems quickly for a while."""
+        self.last_activity = time.monotonic()
+        self.next_status_update = min(
+            self.next_status_update, self.last_activity + self.poll_min_interval
+        )
+        if self.poll_task is not None:
+            self.poll_task.run_before(self.next_status_update - self.last_activity)
+
+    def is_active(self) -> bool:
+        """Return True if the systems must be quickly polled."""
+        if (
+            self.last_activity is not None
+            and time.monotonic() < self.last_activity + self.activity_duration_in_s
+        ):
+            return True
+        return any(
+            system.is_triggered or system.get_active_groups()
+            for system in self.alarm_systems.values()
+        )
+
+    def get_budget_interval(self) -> float:
+        """Return the shortest polling interval keeping the polls within the API budget.
+
+        Each poll costs one request per system (three when the TTM session is opened
+        and closed each time), and complete statuses are also fetched regularly.
+        """
+        systems = len(self.alarm_systems)
+        calls_per_poll = systems * (1 if self.keep_ttm_session else 3)
+        available = (
+            self.api_budget
+            - self.api_reserve
+            - systems * self.api_budget_window / self.full_status_interval
+        )
+        return calls_per_poll * self.api_budget_window / max(1.0, available)
+
+    def get_next_poll_interval(self) -> float:
+        """Return the delay before the next update of the systems."""
+        if self.poll_interval is None:
+            self.poll_interval = BackoffInterval(
+                self.poll_min_interval, self.poll_max_interval
+            )
+        interval = self.poll_interval.next(active=self.is_active())
+        return max(interval, self.get_budget_interval())
+
+    def poll(self) -> float:
+        """Update the systems when it is due; return the delay before the next call.
 
-    def run(self):
-        """Continuously update the systems and looks for alarms."""
+        Called by the scheduler; the first call also fetches the systems and starts
+        checking alarm emails.
+        """
         extra = self.extra_log_data()
-        logger.debug(f"Initialize system data for {self.login}", extra=extra)
-        self.do_login()
-        self.initialize_systems()
-        self.do_logout()
-        while self.is_running:
-            logger.debug(f"Update system data {self.login}", extra=extra)
+        if not self.is_running:
+            return self.poll_max_interval
+        if not self.is_initialized:
+            logger.debug(f"Initialize system data for {self.login}", extra=extra)
+            if self.init_interval is None:
+                self.init_interval = BackoffInterval(
+                    self.poll_min_interval, self.poll_max_interval
+                )
             try:
-                self.update_all_systems()
+                with self.request_lock:
+                    self.ensure_login()
+                    self.initialize_systems()
             except Exception as e:
                 logger.exception(e, extra=extra)
                 capture_some_exception(e)
-            logger.debug(f"Check emails for system {self.login}", extra=extra)
-            check_interval_in_s = 60
-            try:
-                self.check_alarm_emails(
-                    check_count=20, check_interval_in_s=check_interval_in_s
+                return self.init_interval.next(active=False)
+            self.is_initialized = True
+            # email subjects are matched against the names of the systems
+            if self.get_mailbox() is not None and self.is_running:
+                self.email_thread = threading.Thread(
+                    target=self.watch_emails, name=f"imap-{self.login}", daemon=True
                 )
+                self.email_thread.start()
+        if time.monotonic() >= self.next_status_update:
+            logger.debug(f"Update system data {self.login}", extra=extra)
+            try:
+                self.update_all_systems()
             except Exception as e:
                 logger.exception(e, extra=extra)
                 capture_some_exception(e)
-            self.sleep_while_run(check_interval_in_s)
+            self.next_status_update = time.monotonic() + self.get_next_poll_interval()
+            if self.config.verbosity >= 3:
+                usage = self.get_rate_limiter().get_usage()
+                logger.debug(
+                    f"API calls of {self.login} during the last "
+                    f"{self.api_budget_window} seconds: {dict(usage)}",
+                    extra=self.extra_log_data(action="api-budget"),
+                )
+        return self.next_status_update - time.monotonic()
+
+    def change_alarm_state(self, system: DiagralAlarmSystem, groups: Set[int]):
+        """Change the alarm state."""
+        extra = self.extra_log_data(action="alarm_state")
+        logger.info(f"Change alarm state of {system.name} to {groups}", extra=extra)
+        self.notify_activity()
+        with self.request_lock.hold(PRIORITY_COMMAND), self.command_priority():
+            self.ensure_login()
+            system.ensure_session()
+            system.send_activation_command(groups)
+            if not self.keep_ttm_session:
+                system.disconnect_session()
+        time.sleep(1)
+
+    def confirm_alarm_state(self, system: DiagralAlarmSystem, groups: Set[int]) -> bool:
+        """Check a few times that the alarm state has been changed."""
+        for __ in range(self.confirmation_tries):
+            self.sleep_while_run(self.confirmation_interval_in_s)
+            if not self.is_running:
+                break
+            with self.request_lock.hold(PRIORITY_COMMAND), self.command_priority():
+                system.update_status()
+            if system.get_active_groups() == groups:
+                return True
+        return False
+
+    def start(self, scheduler):
+        """Update the systems with the scheduler."""
+        self.is_running = True
+        self.poll_task = scheduler.schedule(
+            self.poll, self.poll_min_interval, name=str(self)
+        )
+
+    def stop(self):
+        """Stop all updates, interrupting current waits."""
+        self.is_running = False
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+
+    def close(self):
+        """Wait for the end of the email checks, then close the session."""
+        if self.email_thread is not None:
+            self.email_thread.join()
+            self.email_thread = None
+        if not self.is_initialized:
+            return
+        try:
+            with self.request_lock:
+                self.end_session()
+        except Exception as e:
+            logger.exception(e, extra=self.extra_log_data())
+            capture_some_exception(e)
+        self.close_http_session()
 
 
 class DiagralHomekitPlugin(HomekitPlugin):
@@ -609,13 +1062,38 @@ class DiagralHomekitPlugin(HomekitPlugin):
         "imap_hostname": str,
         "imap_port": int,
         "imap_use_tls": bool_validator,
+        "imap_archive_directory": str,
+    }
+    smtp_requirements = {
+        "smtp_address": str,
+        "smtp_port": int,
+        "smtp_lmtp": bool_validator,
+    }
+    budget_requirements = {
+        "api_budget": int,
+        "api_budget_window": int,
+    }
+    polling_requirements = {
+        "poll_min_interval": int,
+        "poll_max_interval": int,
+        "full_status_interval": int,
+    }
+    session_requirements = {
+        "session_persist": bool_validator,
+        "keep_ttm_session": bool_validator,
+        "optimistic_updates": bool_validator,
+    }
+    http_requirements = {
+        "http_pool_size": int,
+        "http_connect_timeout": float,
+        "http_read_timeout": float,
     }
 
     def __init__(self, config):
         """init function."""
         super().__init__(config)
         self.diagral_accounts: [Tuple[str, str], DiagralAccount] = {}
-        self.thread_pool = None
+        self.smtp_receivers: Dict[Tuple[str, int], SmtpReceiver] = {}
 
     def get_account(self, login: str, password: str) -> DiagralAccount:
         """Get an account identified by the login and the password."""
@@ -649,7 +1127,19 @@ class DiagralHomekitPlugin(HomekitPlugin):
             account = self.get_account(*key)
 
             # allow to connect to IMAP accounts for fetching alarm emails
-            for attr, checker in self.imap_requirements.items():
+            for attr, checker in (
+                self.imap_requirements | self.smtp_requirements
+            ).items():
+                raw_value = parser.get(section, attr, fallback=None)
+                if raw_value is not None:
+                    setattr(account, attr, checker(raw_value))
+            # optional tuning of the Diagral API sessions
+            for attr, checker in (
+                self.http_requirements
+                | self.session_requirements
+                | self.polling_requirements
+                | self.budget_requirements
+            ).items():
                 raw_value = parser.get(section, attr, fallback=None)
                 if raw_value is not None:
                     setattr(account, attr, checker(raw_value))
@@ -669,17 +1159,50 @@ class DiagralHomekitPlugin(HomekitPlugin):
                 accessory = HomekitAlarm(self, system, bridge.driver)
                 bridge.add_accessory(accessory)
 
+    def get_smtp_receiver(self, account: DiagralAccount) -> SmtpReceiver:
+        """Return the SMTP/LMTP listener of an account, shared with other accounts."""
+        key = (account.smtp_address, account.smtp_port)
+        if key not in self.smtp_receivers:
+            self.smtp_receivers[key] = SmtpReceiver(
+                account.smtp_address, account.smtp_port, lmtp=account.smtp_lmtp
+            )
+        return self.smtp_receivers[key]
+
     def run_all(self):
         """Run all daemons in separate threads."""
-        if self.diagral_accounts:
-            self.thread_pool = ThreadPool(len(self.diagral_accounts))
-            for account in self.diagral_accounts.values():
-                self.thread_pool.apply_async(account.run)
+        for account in self.diagral_accounts.values():
+            if account.smtp_port:
+                receiver = self.get_smtp_receiver(account)
+                receiver.subscribe(account.analyze_email)
+        for receiver in self.smtp_receivers.values():
+            receiver.start()
+        for account in self.diagral_accounts.values():
+            account.start(self.config.scheduler)
 
     def stop_all(self):
         """Stop all accounts."""
         for account in self.diagral_accounts.values():
-            account.is_running = False
+            account.stop()
+        # listeners are bound as soon as they are created, even if not started
+        receivers, self.smtp_receivers = self.smtp_receivers, {}
+        for receiver in receivers.values():
+            try:
+                receiver.stop()
+            except Exception as e:
+                logger.exception(e)
+
+    def join_all(self, timeout_in_s: float):
+        """Close the sessions of all accounts, waiting until the timeout."""
+        end = time.monotonic() + timeout_in_s
+        threads = [
+            threading.Thread(target=account.close, name=f"close-{account.login}")
+            for account in self.diagral_accounts.values()
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(max(0.0, end - time.monotonic()))
 
     @classmethod
     def show_basic_config(cls, login, password):
@@ -707,8 +1230,20 @@ class DiagralHomekitPlugin(HomekitPlugin):
         fd = io.StringIO()
         parser.write(fd)
         account.do_logout()
+        account.close_http_session()
         return fd.getvalue()
 
     @property
     def prometheus_metrics_type(self) -> dict[str, str]:
-        return {"homekit_alarm_state": "gauge", "homekit_alarm_triggered": "gauge"}
+        return {
+            "homekit_alarm_state": "gauge",
+            "homekit_alarm_triggered": "gauge",
+            "homekit_alarm_latency_seconds": "histogram",
+        }
+
+    @property
+    def prometheus_metrics_help(self) -> dict[str, str]:
+        return {
+            "homekit_alarm_latency_seconds": "Delay between an alarm email and its "
+            "display in Homekit, by stage (delivery, match, publish, total).",
+        }
@@ -0,0 +1,74 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file exporter.py is part of DiagralHomekit.                            #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""HTTP endpoint serving the Prometheus metrics of all plugins."""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+import systemlogger
+
+from diagralhomekit.metrics import MetricsRegistry
+
+logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Render the metrics at each request."""
+
+    server: "MetricsExporter"
+
+    def do_GET(self):
+        """Return all metrics on /metrics."""
+        if self.path.partition("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        content = self.server.metrics.render(openmetrics=openmetrics).encode()
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE,
+        )
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """Log requests with the application logger."""
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+class MetricsExporter(ThreadingHTTPServer):
+    """Serve the in-memory metrics on /metrics."""
+
+    daemon_threads = True
+
+    def __init__(self, metrics: MetricsRegistry, port: int, address: str = ""):
+        """init function."""
+        super().__init__((address, port), MetricsHandler)
+        self.metrics = metrics
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        """Return the listening port."""
+        return self.server_address[1]
+
+    def start(self):
+        """Start serving in a separate thread."""
+        logger.info(f"Serving Prometheus metrics on port {self.port}.")
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
@@ -5,7 +5,9 @@
 # ##############################################################################
 """Implements a generic Homekit accessory."""
 import logging
-from threading import Thread
+import time
+from threading import Lock, Thread
+from typing import Callable, Optional, Set, Tuple
 
 import systemlogger
 
@@ -19,12 +21,84 @@ from pyhap.accessory_driver import AccessoryDriver
 from pyhap.const import CATEGORY_ALARM_SYSTEM
 
 from diagralhomekit.alarm_system import AlarmSystem
+from diagralhomekit.characteristics import CharacteristicUpdate
+from diagralhomekit.metrics import Histogram
 from diagralhomekit.plugin import HomekitPlugin
 from diagralhomekit.utils import BASE_AID, capture_some_exception
 
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
 
 
+class AlarmCommandQueue:
+    """Send the commands of an alarm system one at a time.
+
+    A command waiting to be sent is replaced by any newer one (only the latest
+    required state matters) and commands matching the active groups are skipped,
+    unless these groups may be outdated (the state can be changed on the keypad).
+    The callback is called with the state and the error (if any) once done.
+    """
+
+    def __init__(
+        self,
+        alarm_system: AlarmSystem,
+        callback: Callable[[int, Optional[Exception]], None],
+    ):
+        """init function."""
+        self.alarm_system = alarm_system
+        self.callback = callback
+        self.lock = Lock()
+        self.pending: Optional[Tuple[int, Set[int]]] = None
+        self.worker: Optional[Thread] = None
+
+    def submit(self, state: int, groups: Set[int]):
+        """Add a new command, replacing any pending one."""
+        with self.lock:
+            if self.pending is not None:
+                logger.info(
+                    f"Pending command replaced for {self.alarm_system.name}.",
+                    extra=self.alarm_system.extra_log_data(action="set"),
+                )
+            self.pending = (state, groups)
+            if self.worker is None:
+                self.worker = Thread(target=self.run, daemon=True)
+                self.worker.start()
+
+    def run(self):
+        """Send all pending commands."""
+        while True:
+            with self.lock:
+                if self.pending is None:
+                    self.worker = None
+                    return
+                state, groups = self.pending
+                self.pending = None
+            error = None
+            if (
+                groups == self.alarm_system.get_active_groups()
+                and self.alarm_system.has_fresh_groups()
+            ):
+                logger.info(
+                    f"Groups {groups} already active for {self.alarm_system.name}.",
+                    extra=self.alarm_system.extra_log_data(action="set"),
+                )
+            else:
+                try:
+                    self.alarm_system.activate_groups(groups)
+                    # with optimistic updates, the accepted state is already shown
+                    if (
+                        self.alarm_system.optimistic_updates
+                        and not self.alarm_system.confirm_groups(groups)
+                    ):
+                        raise ValueError(
+                            f"Groups {groups} not confirmed by {self.alarm_system.name}."
+                        )
+                except Exception as e:
+                    logger.exception(e, extra=self.alarm_system.extra_log_data())
+                    capture_some_exception(e)
+                    error = e
+            self.callback(state, error)
+
+
 class HomekitAlarm(Accessory):
     """Represent a generic Homekit alarm object."""
 
@@ -81,6 +155,15 @@ class HomekitAlarm(Accessory):
 
         self.alarm_system = system
         self.required_target_state = None
+        # monotonic time of the last failed command, until the state is updated
+        self.command_failed_at: Optional[float] = None
+        # with optimistic updates, the accepted state is shown by the listener
+        self.command_queue = AlarmCommandQueue(system, self.command_done)
+        self.update_lock = Lock()
+        # delay between alarm emails and the triggered state in Homekit
+        self.alarm_latency = Histogram("homekit_alarm_latency_seconds")
+        # changes are immediately displayed, run() is only a safety net
+        system.add_listener(self.update_state)
 
     def set_target_state(self, state: int):
         """Receive a command from the user."""
@@ -105,30 +188,58 @@ class HomekitAlarm(Accessory):
         )
         self.alarm_target_state.set_value(state)
         self.required_target_state = state
+        self.command_queue.submit(state, groups)
 
-        try:
-            thread = Thread(target=self.alarm_system.activate_groups, args=(groups,))
-            thread.start()
-        except Exception as e:
-            logger.exception(e, extra=extra)
-            capture_some_exception(e)
+    def command_done(self, state: int, error: Optional[Exception]):
+        """Receive the result of a command."""
+        if error is None:
+            self.command_failed_at = None
+            return
+        self.command_failed_at = time.monotonic()
+        current_state = self.alarm_current_state.get_value()
+        if (
+            self.required_target_state == state
+            and current_state != self.STATE_ALARM_TRIGGERED
+        ):
+            # the state will not be reached: show the actual one
+            self.required_target_state = None
+            self.alarm_target_state.set_value(current_state)
+        # show the actual state as soon as possible
+        self.update_state()
 
-    @Accessory.run_at_interval(10)
+    @Accessory.run_at_interval(300)
     def run(self):
-        """Check if something has changed."""
+        """Resynchronize all characteristics, in case of a missed change."""
+        self.update_state()
+
+    def update_state(self):
+        """Update all characteristics from the alarm system."""
+        with self.update_lock, CharacteristicUpdate() as update:
+            self._update_state(update)
+
+    def _update_state(self, update: CharacteristicUpdate):
         tags = {"application_fqdn": self.alarm_system.name, "application": "homekit"}
         prometheus_values = []
 
+        updated_at = self.alarm_system.groups_updated_at
+        if (
+            self.command_failed_at is not None
+            and updated_at is not None
+            and updated_at > self.command_failed_at
+        ):
+            # the actual state has been polled since the failure, and is displayed
+            self.command_failed_at = None
         current_fault = self.sensor_status_fault.get_value()
-        fault = 1 if self.alarm_system.status_fault else 0
+        command_failed = self.command_failed_at is not None
+        fault = 1 if self.alarm_system.status_fault or command_failed else 0
         if current_fault != fault:
             extra = self.alarm_system.extra_log_data(fault=str(fault), action="run")
             logger.info(
                 f"Fault state {fault} set for {self.alarm_system.name}.",
                 extra=extra,
             )
-        self.sensor_status_fault.set_value(fault)
-        self.alarm_status_fault.set_value(fault)
+        update.set(self.sensor_status_fault, fault)
+        update.set(self.alarm_status_fault, fault)
         active_groups = self.alarm_system.get_active_groups()
         stay_groups = self.alarm_system.get_stay_groups()
         night_groups = self.alarm_system.get_night_groups()
@@ -148,12 +259,12 @@ class HomekitAlarm(Accessory):
         else:
             state = self.STATE_DISARMED
 
-        self.sensor_status_active.set_value(state != self.STATE_DISARMED)
-        self.sensor_occupancy_detected.set_value(state == self.STATE_ALARM_TRIGGERED)
+        update.set(self.sensor_status_active, state != self.STATE_DISARMED)
+        update.set(self.sensor_occupancy_detected, state == self.STATE_ALARM_TRIGGERED)
         triggered = 1 if self.STATE_ALARM_TRIGGERED else 0
         prometheus_values.append(("homekit_alarm_triggered", triggered, tags))
 
-        self.alarm_alarm_type.set_value(1 if state == self.STATE_ALARM_TRIGGERED else 0)
+        update.set(self.alarm_alarm_type, 1 if state == self.STATE_ALARM_TRIGGERED else 0)
 
         if self.alarm_current_state.get_value() != state:
             extra = self.alarm_system.extra_log_data(
@@ -186,8 +297,27 @@ class HomekitAlarm(Accessory):
                     extra=extra,
                 )
                 self.required_target_state = None
-            self.alarm_target_state.set_value(state)
+            update.set(self.alarm_target_state, state)
 
-        self.alarm_current_state.set_value(state)
+        update.set(self.alarm_current_state, state)
+        if state == self.STATE_ALARM_TRIGGERED:
+            self.observe_trigger_timing(tags)
         prometheus_values.append(("homekit_alarm_state", state, tags))
+        prometheus_values += self.alarm_latency.get_values()
         self.plugin.prometheus_write(prometheus_values)
+
+    def observe_trigger_timing(self, tags: dict[str, str]):
+        """Record the delays of the email that triggered the alarm, now displayed."""
+        timing = self.alarm_system.trigger_timing
+        if timing is None:
+            return
+        self.alarm_system.trigger_timing = None
+        stages = timing.get_stages(time.time())
+        for stage, duration in stages.items():
+            self.alarm_latency.observe(duration, tags | {"stage": stage})
+        if "total" in stages:
+            logger.info(
+                f"Alarm of {self.alarm_system.name} displayed in Homekit "
+                f"{stages['total']:.1f} seconds after the email.",
+                extra=self.alarm_system.extra_log_data(action="latency"),
+            )
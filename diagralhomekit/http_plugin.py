@@ -15,6 +15,7 @@ import systemlogger
 from pyhap.accessory import Accessory
 from pyhap.const import CATEGORY_AIR_PURIFIER
 
+from diagralhomekit.characteristics import CharacteristicUpdate
 from diagralhomekit.plugin import HomekitPlugin
 from diagralhomekit.utils import capture_some_exception
 
@@ -60,8 +61,13 @@ class SupervisionSensor(Accessory):
         prometheus_values = []
         start = time.time()
         parsed_url = urllib.parse.urlparse(self.server_url)
+        api_metrics = self.plugin.config.api_metrics
         try:
-            r = requests.get(self.server_url, allow_redirects=False)
+            with api_metrics.measure(
+                "internet", parsed_url.hostname, parsed_url.path or "/"
+            ) as call:
+                r = requests.get(self.server_url, allow_redirects=False)
+                call.status = r.status_code
             ping = time.time() - start
             homekit_state = QUALITY_UNKNOWN
             status_code = r.status_code
@@ -91,7 +97,9 @@ class SupervisionSensor(Accessory):
             "homekit_http_monitoring_ping", ping,
             {"application_fqdn": parsed_url.hostname, "application": "homekit"},
         ))
-        self.current_quality.set_value(homekit_state)
+        with CharacteristicUpdate() as update:
+            update.set(self.current_quality, homekit_state)
+        self.plugin.prometheus_write(prometheus_values)
         logger.debug(
             f"monitoring of {self.server_url}: {homekit_state} ping={ping} status={status_code})",
             extra={"tags": {"type": "internet", "application_fqdn": parsed_url.hostname, "homekit_state": "homekit_state"}},
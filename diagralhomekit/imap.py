@@ -0,0 +1,416 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file imap.py is part of DiagralHomekit.                                #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Long-lived IMAP connections, and helpers that are missing from imaplib."""
+import imaplib
+import re
+import select
+import ssl
+import time
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import systemlogger
+
+from diagralhomekit.utils import BackoffInterval
+
+logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "alarm", "application": "homekit"})
+
+NEW_MESSAGE_RESPONSE = re.compile(rb"^\* \d+ (EXISTS|RECENT)\b", re.IGNORECASE)
+FETCH_UID = re.compile(rb"\bUID (\d+)", re.IGNORECASE)
+FETCH_SIZE = re.compile(rb"\bRFC822\.SIZE (\d+)", re.IGNORECASE)
+FETCH_START = re.compile(rb"^\d+ \(")
+
+
+def supports_idle(imap_client: imaplib.IMAP4) -> bool:
+    """Return True if the server supports the IDLE command (RFC 2177)."""
+    return "IDLE" in imap_client.capabilities
+
+
+def _has_buffered_data(imap_client: imaplib.IMAP4) -> bool:
+    # lines received with the previous one are kept in the buffer of imaplib;
+    # the socket is made non-blocking, so peek() never waits for new data
+    sock = imap_client.socket()
+    timeout = sock.gettimeout()
+    sock.settimeout(0)
+    try:
+        return bool(imap_client.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _is_readable(imap_client: imaplib.IMAP4, timeout_in_s: float) -> bool:
+    if _has_buffered_data(imap_client):
+        return True
+    sock = imap_client.socket()
+    # decrypted data can be pending in the SSL layer, invisible to select()
+    pending = getattr(sock, "pending", None)
+    if pending is not None and pending():
+        return True
+    readable, __, __ = select.select([sock], [], [], timeout_in_s)
+    return bool(readable)
+
+
+def idle(
+    imap_client: imaplib.IMAP4,
+    timeout_in_s: float,
+    is_running: Callable[[], bool] = lambda: True,
+    check_interval_in_s: float = 1.0,
+) -> bool:
+    """Wait for new messages in the selected mailbox with the IDLE command.
+
+    Return True as soon as a new message is announced by the server, or False
+    after the timeout (or when `is_running()` becomes False).
+    """
+    # noinspection PyUnresolvedReferences,PyProtectedMember
+    tag = imap_client._new_tag()
+    imap_client.send(tag + b" IDLE\r\n")
+    line = imap_client.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+    has_new_messages = False
+    end = time.monotonic() + timeout_in_s
+    while not has_new_messages and is_running():
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+        if not _is_readable(imap_client, min(remaining, check_interval_in_s)):
+            continue
+        line = imap_client.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE.")
+        has_new_messages = bool(NEW_MESSAGE_RESPONSE.match(line))
+    imap_client.send(b"DONE\r\n")
+    # untagged responses can still be received before the end of IDLE
+    while True:
+        line = imap_client.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE.")
+        if line.startswith(tag):
+            if not line[len(tag) :].strip().upper().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE failed: {line!r}")
+            return has_new_messages
+        has_new_messages = has_new_messages or bool(NEW_MESSAGE_RESPONSE.match(line))
+
+
+def get_uid_validity(imap_client: imaplib.IMAP4) -> Optional[int]:
+    """Return the UIDVALIDITY value sent when the mailbox has been selected."""
+    __, data = imap_client.response("UIDVALIDITY")
+    if not data or data[-1] is None:
+        return None
+    return int(data[-1])
+
+
+def to_sequence_set(uids: List[int]) -> str:
+    """Return a compact IMAP sequence set for the given UIDs.
+
+    >>> to_sequence_set([7, 1, 2, 3, 5, 6])
+    '1:3,5:7'
+    >>> to_sequence_set([4])
+    '4'
+    """
+    ranges = []
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(x) if x == y else f"{x}:{y}" for x, y in ranges)
+
+
+def parse_fetch_response(data) -> List[Tuple[int, Optional[int], Optional[bytes]]]:
+    """Parse the result of a FETCH command requesting the UID, the size and one part.
+
+    Return a list of (UID, size, part) tuples. Items can be sent in any order, so
+    the UID can also be given after the part.
+
+    >>> parse_fetch_response([(b"1 (UID 7 BODY[HEADER] {4}", b"a: b"), b")"])
+    [(7, None, b'a: b')]
+    >>> parse_fetch_response([(b"1 (RFC822.SIZE 12 BODY[HEADER] {4}", b"a: b"), b" UID 7)"])
+    [(7, 12, b'a: b')]
+    >>> parse_fetch_response([b"1 (UID 7 RFC822.SIZE 12)"])
+    [(7, 12, None)]
+    """
+    # [metadata, part] of each message
+    messages = []
+    for item in data:
+        if isinstance(item, tuple):
+            messages.append([item[0], item[1]])
+        elif isinstance(item, bytes):
+            if FETCH_START.match(item):
+                messages.append([item, None])
+            elif messages:  # end of the previous message, after its literal
+                messages[-1][0] += item
+    result = []
+    for meta, part in messages:
+        uid_matcher = FETCH_UID.search(meta)
+        if not uid_matcher:
+            continue
+        size_matcher = FETCH_SIZE.search(meta)
+        size = int(size_matcher.group(1)) if size_matcher else None
+        result.append((int(uid_matcher.group(1)), size, part))
+    return result
+
+
+class ImapMailbox:
+    """Long-lived connection to an IMAP mailbox, shared by all accounts using it.
+
+    New messages are fetched once and given to all subscribed handlers, then deleted.
+    Only one thread can use the connection at a time (see `lock`).
+    """
+
+    instances: Dict[Tuple[str, int, str, str], "ImapMailbox"] = {}
+    instances_lock = Lock()
+    # a NOOP command checks the connection when it has not been used for a while
+    keepalive_interval_in_s = 300
+
+    def __init__(
+        self,
+        hostname: str,
+        port: int,
+        login: str,
+        password: str,
+        use_tls: bool = True,
+        directory: str = "INBOX",
+        archive_directory: str = "",
+    ):
+        """init function.
+
+        :param archive_directory: processed messages are moved to this mailbox
+            instead of being deleted
+        """
+        self.hostname = hostname
+        self.port = port
+        self.login = login
+        self.password = password
+        self.use_tls = use_tls
+        self.directory = directory
+        self.archive_directory = archive_directory
+        self.client: Optional[imaplib.IMAP4] = None
+        # held during each use of the connection, including IDLE
+        self.lock = Lock()
+        self.handlers: List[Callable[[bytes, float], None]] = []
+        # only protects the handlers, so subscribing never waits for IDLE
+        self.handlers_lock = Lock()
+        self.uid_validity: Optional[int] = None
+        self.last_uid = 0
+        self.last_command = 0.0
+        self.reconnect_interval = BackoffInterval(5, 600)
+        self.next_connection = 0.0
+
+    @classmethod
+    def get_mailbox(
+        cls,
+        hostname: str,
+        port: int,
+        login: str,
+        password: str,
+        use_tls: bool = True,
+        directory: str = "INBOX",
+        archive_directory: str = "",
+    ) -> "ImapMailbox":
+        """Return the connection to the given mailbox, creating it if required."""
+        key = (hostname, port, login, directory)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(
+                    hostname,
+                    port,
+                    login,
+                    password,
+                    use_tls=use_tls,
+                    directory=directory,
+                    archive_directory=archive_directory,
+                )
+            return cls.instances[key]
+
+    def __str__(self):
+        """Return a string."""
+        return f"{self.login}@{self.hostname}:{self.port}"
+
+    def extra_log_data(self, **kwargs):
+        """Extra data for logging events."""
+        return {"tags": {"identifier": str(self), "type": "imap", **kwargs}}
+
+    def subscribe(self, handler: Callable[[bytes, float], None]):
+        """Call the handler with the headers and the reception time of each new message."""
+        with self.handlers_lock:
+            if handler not in self.handlers:
+                self.handlers.append(handler)
+
+    def unsubscribe(self, handler: Callable[[bytes, float], None]):
+        """Remove a handler, closing the connection when it was the last one."""
+        with self.handlers_lock:
+            if handler in self.handlers:
+                self.handlers.remove(handler)
+            is_unused = not self.handlers
+        if is_unused:
+            with self.lock:
+                self.disconnect()
+
+    @property
+    def is_available(self) -> bool:
+        """Return False while waiting before a new connection attempt."""
+        return self.client is not None or time.monotonic() >= self.next_connection
+
+    def connect(self) -> imaplib.IMAP4:
+        """Return the connection, opening it if required.
+
+        Failed connections are not tried again before an increasing delay.
+        """
+        if self.client is not None:
+            if time.monotonic() - self.last_command < self.keepalive_interval_in_s:
+                return self.client
+            try:
+                self.client.noop()
+                self.last_command = time.monotonic()
+                return self.client
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.info(f"Connection lost to {self}: {e}", extra=self.extra_log_data())
+                self.disconnect()
+        if time.monotonic() < self.next_connection:
+            raise ValueError(f"Waiting before reconnecting to {self}.")
+        logger.debug(f"Connect to {self}", extra=self.extra_log_data(action="connect"))
+        try:
+            self.client = self._open_connection()
+        except Exception:
+            self.next_connection = time.monotonic() + self.reconnect_interval.next(
+                active=False
+            )
+            self.disconnect()
+            raise
+        self.reconnect_interval.reset()
+        self.last_command = time.monotonic()
+        return self.client
+
+    def _open_connection(self) -> imaplib.IMAP4:
+        cls = imaplib.IMAP4_SSL if self.use_tls else imaplib.IMAP4
+        client = cls(self.hostname, self.port)
+        try:
+            if not self.use_tls:
+                try:
+                    client.starttls()
+                except imaplib.IMAP4.error:
+                    pass
+            client.login(self.login, self.password)
+            typ, data = client.select(mailbox=self.directory, readonly=False)
+            if typ != "OK":
+                raise ValueError(f"Invalid mailbox {self.directory}")
+        except Exception:
+            client.shutdown()
+            raise
+        uid_validity = get_uid_validity(client)
+        if uid_validity is None or uid_validity != self.uid_validity:
+            # previous UIDs are meaningless, so all messages must be checked
+            self.uid_validity = uid_validity
+            self.last_uid = 0
+        return client
+
+    def disconnect(self):
+        """Close the connection."""
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            client.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+    def supports_idle(self) -> bool:
+        """Return True if the server supports the IDLE command."""
+        return self.client is not None and supports_idle(self.client)
+
+    def idle(self, timeout_in_s: float, is_running: Callable[[], bool]) -> bool:
+        """Wait for new messages; return True if a new one is announced."""
+        client = self.connect()
+        try:
+            result = idle(client, timeout_in_s, is_running=is_running)
+        except (imaplib.IMAP4.error, OSError):
+            self.disconnect()
+            raise
+        self.last_command = time.monotonic()
+        return result
+
+    def check(self, verbose: bool = False):
+        """Fetch the headers of new messages, give them to all handlers and delete them.
+
+        Only messages with a UID greater than the last seen one are fetched,
+        with a single command whatever the number of messages in the mailbox.
+        """
+        client = self.connect()
+        if verbose:
+            logger.debug(f"Search in {self}", extra=self.extra_log_data(action="search"))
+        try:
+            self._check(client)
+        except (imaplib.IMAP4.error, OSError):
+            self.disconnect()
+            raise
+        self.last_command = time.monotonic()
+
+    def _check(self, client: imaplib.IMAP4):
+        typ, data = client.uid(
+            "FETCH",
+            f"{self.last_uid + 1}:*",
+            "(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (SUBJECT DATE FROM)])",
+        )
+        if typ != "OK":
+            raise ValueError("Unable to fetch new IMAP messages.")
+        received_at = time.time()
+        with self.handlers_lock:
+            handlers = list(self.handlers)
+        processed = []
+        for uid, size, header in parse_fetch_response(data):
+            # "n:*" always includes the last message, even if its UID is lower than n
+            if uid <= self.last_uid:
+                continue
+            self.last_uid = uid
+            if header is None:
+                # never delete a message that has not been read
+                logger.warning(
+                    f"No header received for email {uid} from {self}",
+                    extra=self.extra_log_data(action="found"),
+                )
+                continue
+            logger.debug(
+                f"Fetch email {uid} ({size} bytes) from {self}",
+                extra=self.extra_log_data(action="found"),
+            )
+            for handler in handlers:
+                handler(header, received_at)
+            processed.append(uid)
+        if processed:
+            self.remove(client, processed)
+
+    def remove(self, client: imaplib.IMAP4, uids: List[int]):
+        """Delete (or archive) processed messages with as few commands as possible."""
+        sequence_set = to_sequence_set(uids)
+        capabilities = client.capabilities
+        if self.archive_directory:
+            logger.debug(
+                f"Move emails {sequence_set} from {self} to {self.archive_directory}",
+                extra=self.extra_log_data(action="archive"),
+            )
+            if "MOVE" in capabilities:  # RFC 6851
+                typ, data = client.uid("MOVE", sequence_set, self.archive_directory)
+                if typ != "OK":
+                    raise ValueError(
+                        f"Unable to move messages to {self.archive_directory}"
+                    )
+                return
+            typ, data = client.uid("COPY", sequence_set, self.archive_directory)
+            if typ != "OK":
+                raise ValueError(f"Unable to copy messages to {self.archive_directory}")
+        else:
+            logger.debug(
+                f"Delete emails {sequence_set} from {self}",
+                extra=self.extra_log_data(action="delete"),
+            )
+        client.uid("STORE", sequence_set, "+FLAGS", r"(\Deleted)")
+        if "UIDPLUS" in capabilities:  # RFC 4315, only expunge our own messages
+            client.uid("EXPUNGE", sequence_set)
+        else:
+            client.expunge()
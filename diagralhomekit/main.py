@@ -20,6 +20,7 @@ from pyhap.accessory_driver import AccessoryDriver
 
 from diagralhomekit.config import HomekitConfig
 from diagralhomekit.diagral import DiagralHomekitPlugin
+from diagralhomekit.exporter import MetricsExporter
 
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
 
@@ -30,6 +31,7 @@ def main():
     default_port = int(os.environ.get("DIAGRAL_PORT", "51826"))
     default_config_dir = os.environ.get("DIAGRAL_CONFIG", "/etc/diagralhomekit")
     verbosity = int(os.environ.get("DIAGRAL_VERBOSITY", 0))
+    default_metrics_port = int(os.environ.get("DIAGRAL_METRICS_PORT", 0))
     parser.add_argument(
         "--create-config",
         help="--create-config 'email:password' display a sample configuration file",
@@ -43,6 +45,12 @@ def main():
         type=pathlib.Path,
     )
     parser.add_argument("-v", "--verbosity", default=verbosity, type=int)
+    parser.add_argument(
+        "--metrics-port",
+        help="serve Prometheus metrics on http://[host]:[port]/metrics",
+        default=default_metrics_port,
+        type=int,
+    )
     args = parser.parse_args()
     config_dir = args.config_dir
     if args.create_config:
@@ -63,6 +71,7 @@ def main():
                 config_dir,
                 listen_port,
                 verbosity=args.verbosity,
+                metrics_port=args.metrics_port,
             )
         except KeyboardInterrupt:
             continue_loop = False
@@ -71,7 +80,7 @@ def main():
             time.sleep(60)
 
 
-def run_daemons(config_dir, listen_port, verbosity: int = 1):
+def run_daemons(config_dir, listen_port, verbosity: int = 1, metrics_port: int = 0):
     """launch all processes: Homekit and Diagral checker."""
     persist_file = config_dir / "persist.json"
     config_file = config_dir / "config.ini"
@@ -90,6 +99,18 @@ def run_daemons(config_dir, listen_port, verbosity: int = 1):
     config.load_accessories(bridge)
     driver.add_accessory(accessory=bridge)
     signal.signal(signal.SIGTERM, driver.signal_handler)
-    config.run_all()
-    driver.start()
-    config.stop_all()
+    exporter = None
+    try:
+        if metrics_port:
+            exporter = MetricsExporter(config.metrics, metrics_port)
+            exporter.start()
+        config.run_all()
+        driver.start()
+    finally:
+        # also release the listening ports and threads after a startup error,
+        # since run_daemons is called again
+        try:
+            config.stop_all()
+        finally:
+            if exporter is not None:
+                exporter.stop()
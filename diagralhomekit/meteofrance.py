@@ -4,14 +4,13 @@
 #  Please check the LICENSE file for sharing or distribution permissions.      #
 # ##############################################################################
 """Add weather sensor that takes data from the MeteoFrance website."""
-import time
 from configparser import ConfigParser
-from multiprocessing.pool import ThreadPool
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
 import systemlogger
 from meteofrance_api import MeteoFranceClient
 from meteofrance_api.model import Place
+from meteofrance_api.session import MeteoFranceSession
 
 # noinspection PyPackageRequirements
 from pyhap.accessory import Accessory
@@ -19,7 +18,9 @@ from pyhap.accessory import Accessory
 # noinspection PyPackageRequirements
 from pyhap.const import CATEGORY_SENSOR
 
+from diagralhomekit.characteristics import CharacteristicUpdate
 from diagralhomekit.plugin import HomekitPlugin
+from diagralhomekit.scheduler import ScheduledTask
 
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
 
@@ -63,6 +64,20 @@ class MeteoFranceSensor(Accessory):
         self.status_fault = service.configure_char("StatusFault")
 
 
+class MeteoFranceTimeoutSession(MeteoFranceSession):
+    """Session whose requests always have a timeout."""
+
+    def __init__(self, timeout: Tuple[float, float]):
+        """init function."""
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, *args, **kwargs):
+        """Make a request, with the default timeout."""
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, path, *args, **kwargs)
+
+
 class MeteoFranceLocation:
     """Represent a location to check."""
 
@@ -71,7 +86,9 @@ class MeteoFranceLocation:
         self.config = config
         self.place = place
         self.sensors: Dict[str, MeteoFranceSensor] = {}
-        self.is_running = True
+        # requests are run by the shared scheduler, so they must never hang
+        self.http_connect_timeout = 10.0
+        self.http_read_timeout = 30.0
 
     def __str__(self):
         """Return a string."""
@@ -83,52 +100,52 @@ class MeteoFranceLocation:
             "tags": {"identifier": self.place.name, "type": "meteofrance", **kwargs}
         }
 
-    def sleep_while_run(self, interval_in_s: int):
-        """Sleep for the given interval if active."""
-        for __ in range(interval_in_s * 10):
-            if not self.is_running:
-                return
-            time.sleep(0.1)
-
-    def run(self):
-        """Continuously update the systems and looks for weather changes."""
+    def update(self):
+        """Update the sensors, called by the scheduler."""
         extra = self.extra_log_data()
-        while self.is_running:
-            logger.debug(f"Update weather data for {self.place.name}", extra=extra)
-            try:
-                self.update_all_sensors()
-            except Exception as e:
-                logger.exception(e)
+        logger.debug(f"Update weather data for {self.place.name}", extra=extra)
+        try:
+            self.update_all_sensors()
+        except Exception as e:
+            logger.exception(e)
+            with CharacteristicUpdate() as update:
                 for sensor in self.sensors.values():
-                    sensor.status_fault.set_value(1)
-            self.sleep_while_run(300)
+                    update.set(sensor.status_fault, 1)
 
     def update_all_sensors(self):
         """Update all weather sensors."""
         client = MeteoFranceClient()
-        my_place_weather_forecast = client.get_forecast_for_place(self.place)
+        client.session = MeteoFranceTimeoutSession(
+            (self.http_connect_timeout, self.http_read_timeout)
+        )
+        # self.config is the plugin
+        api_metrics = self.config.config.api_metrics
+        with api_metrics.measure("meteofrance", self.place.name, "forecast"):
+            my_place_weather_forecast = client.get_forecast_for_place(self.place)
         data = my_place_weather_forecast.daily_forecast[0]
         prometheus_values = []
         tags = {"application_fqdn": 'meteofrance', "application": "homekit", "location": self.place.name}
-        for char_name, sensor in self.sensors.items():
-            if char_name == "temperature_max":
-                sensor.service_char.set_value(data["T"]["max"])
-                prometheus_values.append(("homekit_temperature_max", data["T"]["max"], tags))
-            elif char_name == "temperature_min":
-                sensor.service_char.set_value(data["T"]["min"])
-                prometheus_values.append(("homekit_temperature_min", data["T"]["min"], tags))
-            elif char_name == "humidity_min":
-                sensor.service_char.set_value(data["humidity"]["max"])
-                prometheus_values.append(("homekit_humidity_max", data["humidity"]["max"], tags))
-            elif char_name == "humidity_max":
-                sensor.service_char.set_value(data["humidity"]["min"])
-                prometheus_values.append(("homekit_humidity_min", data["humidity"]["min"], tags))
-            elif char_name == "rain_forecast":
-                forecast = client.get_rain(self.place.latitude, self.place.longitude)
-                value = 1 if bool(forecast.next_rain_date_locale()) else 0
-                sensor.service_char.set_value(value)
-                prometheus_values.append(("homekit_rain_forecast", value, tags))
-            sensor.status_fault.set_value(0)
+        with CharacteristicUpdate() as update:
+            for char_name, sensor in self.sensors.items():
+                if char_name == "temperature_max":
+                    update.set(sensor.service_char, data["T"]["max"])
+                    prometheus_values.append(("homekit_temperature_max", data["T"]["max"], tags))
+                elif char_name == "temperature_min":
+                    update.set(sensor.service_char, data["T"]["min"])
+                    prometheus_values.append(("homekit_temperature_min", data["T"]["min"], tags))
+                elif char_name == "humidity_min":
+                    update.set(sensor.service_char, data["humidity"]["max"])
+                    prometheus_values.append(("homekit_humidity_max", data["humidity"]["max"], tags))
+                elif char_name == "humidity_max":
+                    update.set(sensor.service_char, data["humidity"]["min"])
+                    prometheus_values.append(("homekit_humidity_min", data["humidity"]["min"], tags))
+                elif char_name == "rain_forecast":
+                    with api_metrics.measure("meteofrance", self.place.name, "rain"):
+                        forecast = client.get_rain(self.place.latitude, self.place.longitude)
+                    value = 1 if bool(forecast.next_rain_date_locale()) else 0
+                    update.set(sensor.service_char, value)
+                    prometheus_values.append(("homekit_rain_forecast", value, tags))
+                update.set(sensor.status_fault, 0)
         self.config.prometheus_write(prometheus_values)
 
 
@@ -136,6 +153,7 @@ class MeteoFrancePlugin(HomekitPlugin):
     """Plugin for weather predictions."""
 
     config_prefix = "meteofrance"
+    update_interval_in_s = 300
     requirements = {
         "name": str,
         "latitude": float,
@@ -148,7 +166,7 @@ class MeteoFrancePlugin(HomekitPlugin):
         """init function."""
         super().__init__(config)
         self.locations: List[MeteoFranceLocation] = []
-        self.thread_pool = None
+        self.tasks: List[ScheduledTask] = []
 
     def load_config(self, parser: ConfigParser, section):
         """Load a configuration section."""
@@ -185,16 +203,21 @@ class MeteoFrancePlugin(HomekitPlugin):
         return config_errors
 
     def run_all(self):
-        """Run all daemons in separate threads."""
-        if self.locations:
-            self.thread_pool = ThreadPool(len(self.locations))
-            for location in self.locations:
-                self.thread_pool.apply_async(location.run)
+        """Update all locations at regular intervals."""
+        for location in self.locations:
+            task = self.config.scheduler.schedule(
+                location.update,
+                self.update_interval_in_s,
+                jitter_in_s=30,
+                name=str(location),
+            )
+            self.tasks.append(task)
 
     def stop_all(self):
         """Stop all accounts."""
-        for location in self.locations:
-            location.is_running = False
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
 
     def load_accessories(self, bridge):
         """Add accessories to the Homekit bridge."""
@@ -0,0 +1,355 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file metrics.py is part of DiagralHomekit.                             #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Prometheus metrics, and the timing of alarms from the email to Homekit."""
+import bisect
+import contextlib
+import os
+import tempfile
+import time
+from threading import Lock, Timer
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import systemlogger
+from requests.exceptions import ConnectionError, RequestException, Timeout
+
+logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
+
+PrometheusValue = Tuple[str, float, Dict[str, str]]
+
+
+class Histogram:
+    """Cumulative Prometheus histogram, with one series per set of labels.
+
+    >>> histogram = Histogram("latency_seconds", buckets=(1, 5))
+    >>> histogram.observe(0.5, {"stage": "total"})
+    >>> histogram.observe(3, {"stage": "total"})
+    >>> for value in histogram.get_values():
+    ...     print(value)
+    ('latency_seconds_bucket', 1, {'stage': 'total', 'le': '1'})
+    ('latency_seconds_bucket', 2, {'stage': 'total', 'le': '5'})
+    ('latency_seconds_bucket', 2, {'stage': 'total', 'le': '+Inf'})
+    ('latency_seconds_sum', 3.5, {'stage': 'total'})
+    ('latency_seconds_count', 2, {'stage': 'total'})
+    """
+
+    default_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, name: str, buckets: Optional[Sequence[float]] = None):
+        """init function."""
+        self.name = name
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        # labels -> (count in each bucket (not cumulative) and above, sum)
+        self.series: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float]] = {}
+        self.lock = Lock()
+
+    def observe(self, value: float, labels: Dict[str, str]):
+        """Add a new value."""
+        key = tuple(labels.items())
+        with self.lock:
+            counts, total = self.series.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[key] = (counts, total + value)
+
+    def get_values(self, labels: Optional[Dict[str, str]] = None) -> List[PrometheusValue]:
+        """Return the values for prometheus_write(), only for the given labels if any."""
+        values = []
+        with self.lock:
+            if labels is None:
+                all_series = list(self.series.items())
+            else:
+                key = tuple(labels.items())
+                all_series = [(key, self.series[key])] if key in self.series else []
+            for key, (counts, total) in all_series:
+                labels = dict(key)
+                cumulated = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulated += count
+                    bucket_labels = labels | {"le": str(bound)}
+                    values.append((f"{self.name}_bucket", cumulated, bucket_labels))
+                values.append((f"{self.name}_sum", total, labels))
+                values.append((f"{self.name}_count", cumulated, labels))
+        return values
+
+
+class Counter:
+    """Prometheus counter, with one series per set of labels.
+
+    >>> counter = Counter("homekit_api_requests_total")
+    >>> counter.inc({"status": "200"})
+    >>> counter.inc({"status": "200"})
+    >>> counter.get_values({"status": "200"})
+    [('homekit_api_requests_total', 2, {'status': '200'})]
+    """
+
+    def __init__(self, name: str):
+        """init function."""
+        self.name = name
+        self.series: Dict[Tuple[Tuple[str, str], ...], float] = {}
+        self.lock = Lock()
+
+    def inc(self, labels: Dict[str, str], amount: float = 1):
+        """Increment the counter."""
+        key = tuple(labels.items())
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def get_values(self, labels: Optional[Dict[str, str]] = None) -> List[PrometheusValue]:
+        """Return the values for prometheus_write(), only for the given labels if any."""
+        with self.lock:
+            if labels is None:
+                return [(self.name, v, dict(k)) for k, v in self.series.items()]
+            key = tuple(labels.items())
+            return [(self.name, self.series[key], labels)] if key in self.series else []
+
+
+def format_series(name: str, labels: Dict[str, str]) -> str:
+    r"""Return the name and the labels of a series, in the Prometheus text format.
+
+    >>> format_series("homekit_alarm_state", {"application": "homekit", "name": 'a "b"\n'})
+    'homekit_alarm_state{application="homekit",name="a \\"b\\"\\n"}'
+    >>> format_series("homekit_alarm_state", {})
+    'homekit_alarm_state'
+    """
+    if not labels:
+        return name
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class MetricsRegistry:
+    """In-memory values of all plugins, written to Prometheus text files.
+
+    Plugins only update their series in memory. Each file is then rewritten at most
+    once every `debounce_in_s` seconds with all its series (whatever the plugin that
+    updated them), through a temporary file so readers never see a partial file.
+    Values without file are only kept in memory, for the HTTP exporter.
+    """
+
+    debounce_in_s = 1.0
+
+    def __init__(self):
+        """init function."""
+        self.lock = Lock()
+        # filename (or None) -> (name, labels) -> [formatted series, value]
+        self.files: Dict[Optional[str], Dict[Tuple[str, tuple], list]] = {}
+        self.types: Dict[str, str] = {}
+        self.helps: Dict[str, str] = {}
+        self.timers: Dict[str, Timer] = {}
+
+    def describe(self, types: Dict[str, str], helps: Dict[str, str]):
+        """Add the types and the help texts of metrics."""
+        with self.lock:
+            self.types.update(types)
+            self.helps.update(helps)
+
+    def update(self, filename: Optional[str], values: Iterable[PrometheusValue]):
+        """Set new values and schedule the write of the file, if any."""
+        with self.lock:
+            series = self.files.setdefault(filename, {})
+            for name, value, labels in values:
+                key = (name, tuple(labels.items()))
+                if key in series:
+                    series[key][1] = value
+                else:
+                    series[key] = [format_series(name, labels), value]
+            if filename is not None and filename not in self.timers:
+                timer = Timer(self.debounce_in_s, self.write, args=(filename,))
+                timer.daemon = True
+                self.timers[filename] = timer
+                timer.start()
+
+    def get_family(self, name: str) -> str:
+        """Return the metric described by the type of the given series."""
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and name[: -len(suffix)] in self.types:
+                return name[: -len(suffix)]
+        return name
+
+    def render(self, filename: Optional[str] = None, openmetrics: bool = False) -> str:
+        """Return the content of a file, or all values if no filename is given.
+
+        With `openmetrics`, the OpenMetrics text format is used instead of the
+        Prometheus one.
+        """
+        families: Dict[str, Dict[Tuple[str, tuple], str]] = {}
+        with self.lock:
+            if filename is None:
+                all_series = [x for series in self.files.values() for x in series.items()]
+            else:
+                all_series = self.files.get(filename, {}).items()
+            for key, (series, value) in all_series:
+                family = families.setdefault(self.get_family(key[0]), {})
+                family[key] = f"{series} {value}\n"
+            lines = []
+            for name, values in families.items():
+                family, metric_type = name, self.types.get(name)
+                if openmetrics:
+                    # counters are described without the suffix of their samples
+                    if metric_type == "counter" and name.endswith("_total"):
+                        family = name[: -len("_total")]
+                    if metric_type == "untyped":
+                        metric_type = "unknown"
+                if metric_type is not None:
+                    lines.append(f"# TYPE {family} {metric_type}\n")
+                if name in self.helps:
+                    lines.append(f"# HELP {family} {self.helps[name]}\n")
+                lines += values.values()
+        if openmetrics:
+            lines.append("# EOF\n")
+        return "".join(lines)
+
+    def write(self, filename: str):
+        """Replace the file with the current values."""
+        with self.lock:
+            self.timers.pop(filename, None)
+        content = self.render(filename)
+        dirname = os.path.dirname(os.path.abspath(filename))
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=dirname, prefix=".prometheus-", delete=False
+            ) as fd:
+                fd.write(content)
+            os.chmod(fd.name, 0o644)
+            os.replace(fd.name, filename)
+        except OSError as e:
+            logger.warning(f"Unable to write Prometheus metrics to {filename}: {e}")
+
+    def flush(self):
+        """Write all pending files now."""
+        with self.lock:
+            timers, self.timers = self.timers, {}
+        for filename, timer in timers.items():
+            timer.cancel()
+            self.write(filename)
+
+
+class TriggerTiming:
+    """Wall-clock timestamps of an alarm, from the email to Homekit.
+
+    The sending time comes from the Date header of the email, so it is only precise
+    to the second (and depends on the clock of the Diagral servers).
+    """
+
+    def __init__(
+        self, sent_at: Optional[float], received_at: float, matched_at: float
+    ):
+        """init function."""
+        self.sent_at = sent_at
+        self.received_at = received_at
+        self.matched_at = matched_at
+
+    def get_stages(self, published_at: float) -> Dict[str, float]:
+        """Return the duration of each stage, in seconds.
+
+        >>> timing = TriggerTiming(100.0, 102.5, 102.75)
+        >>> timing.get_stages(104.0)
+        {'match': 0.25, 'publish': 1.25, 'delivery': 2.5, 'total': 4.0}
+        """
+        stages = {
+            "match": self.matched_at - self.received_at,
+            "publish": published_at - self.matched_at,
+        }
+        if self.sent_at is not None:
+            stages["delivery"] = self.received_at - self.sent_at
+            stages["total"] = published_at - self.sent_at
+        # clocks of the sender and of this computer can differ
+        return {k: max(0.0, v) for k, v in stages.items()}
+
+
+class ApiCall:
+    """Result of a call measured by `ApiMetrics.measure`."""
+
+    def __init__(self):
+        """init function."""
+        self.status: Optional[int] = None
+
+
+class ApiMetrics:
+    """Latency, status codes, errors and retries of calls to remote APIs.
+
+    Series are labelled by plugin, account and endpoint, and kept in the registry
+    (so they are served by the HTTP exporter).
+    """
+
+    types = {
+        "homekit_api_request_duration_seconds": "histogram",
+        "homekit_api_requests_total": "counter",
+        "homekit_api_errors_total": "counter",
+        "homekit_api_retries_total": "counter",
+    }
+    helps = {
+        "homekit_api_request_duration_seconds": "Duration of calls to remote APIs.",
+        "homekit_api_requests_total": "Answers of remote APIs, by HTTP status code.",
+        "homekit_api_errors_total": "Calls to remote APIs without any answer "
+        "(timeout, connection or other error).",
+        "homekit_api_retries_total": "Calls to remote APIs tried again.",
+    }
+
+    def __init__(self, registry: MetricsRegistry):
+        """init function."""
+        self.registry = registry
+        registry.describe(self.types, self.helps)
+        self.durations = Histogram("homekit_api_request_duration_seconds")
+        self.requests = Counter("homekit_api_requests_total")
+        self.errors = Counter("homekit_api_errors_total")
+        self.retries = Counter("homekit_api_retries_total")
+
+    @contextlib.contextmanager
+    def measure(self, plugin: str, account: str, endpoint: str):
+        """Measure a call; set the `status` attribute of the result when available.
+
+        >>> api_metrics = ApiMetrics(MetricsRegistry())
+        >>> with api_metrics.measure("plex", "http://localhost", "servers") as call:
+        ...     call.status = 200
+        >>> api_metrics.requests.get_values()[0]
+        ('homekit_api_requests_total', 1, {'plugin': 'plex', 'account': 'http://localhost', 'endpoint': 'servers', 'status': '200'})
+        """
+        labels = {"plugin": plugin, "account": account, "endpoint": endpoint}
+        call = ApiCall()
+        start = time.monotonic()
+        try:
+            yield call
+        except Exception as e:
+            response = getattr(e, "response", None)
+            if response is not None:  # like raise_for_status()
+                call.status = response.status_code
+            else:
+                self.record_error(labels, e)
+            raise
+        finally:
+            self.durations.observe(time.monotonic() - start, labels)
+            self.publish(self.durations.get_values(labels))
+            if call.status is not None:
+                status_labels = labels | {"status": str(call.status)}
+                self.requests.inc(status_labels)
+                self.publish(self.requests.get_values(status_labels))
+
+    def record_error(self, labels: Dict[str, str], e: Exception):
+        """Count a call without any answer."""
+        if isinstance(e, Timeout):
+            error = "timeout"
+        elif isinstance(e, ConnectionError):
+            error = "connection"
+        elif isinstance(e, RequestException):
+            error = "request"
+        else:
+            error = "other"
+        error_labels = labels | {"error": error}
+        self.errors.inc(error_labels)
+        self.publish(self.errors.get_values(error_labels))
+
+    def record_retry(self, plugin: str, account: str, endpoint: str):
+        """Count a call tried again."""
+        labels = {"plugin": plugin, "account": account, "endpoint": endpoint}
+        self.retries.inc(labels)
+        self.publish(self.retries.get_values(labels))
+
+    def publish(self, values: List[PrometheusValue]):
+        """Update the registry."""
+        self.registry.update(None, values)
@@ -16,6 +16,7 @@ from pyhap.accessory import Accessory
 # noinspection PyPackageRequirements
 from pyhap.const import CATEGORY_SENSOR
 
+from diagralhomekit.characteristics import CharacteristicUpdate
 from diagralhomekit.plugin import HomekitPlugin
 
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
@@ -70,9 +71,10 @@ class UPSSensor(Accessory):
         battery_threshold = int(data["battery.charge.low"])
         is_low = 1 if battery_level <= battery_threshold else 0
 
-        self.battery_level.set_value(battery_level)
-        self.status_low_battery.set_value(is_low)
-        self.charging_state.set_value(1 if data["ups.status"] == "OL" else 0)
+        with CharacteristicUpdate() as update:
+            update.set(self.battery_level, battery_level)
+            update.set(self.status_low_battery, is_low)
+            update.set(self.charging_state, 1 if data["ups.status"] == "OL" else 0)
 
 
 class UPSMonitoringPlugin(HomekitPlugin):
@@ -4,9 +4,7 @@
 #  Please check the LICENSE file for sharing or distribution permissions.      #
 # ##############################################################################
 """Plex plugin, to add a OccupancySensor for each player."""
-import time
 from configparser import ConfigParser
-from multiprocessing.pool import ThreadPool
 from typing import Dict, List, Optional, Tuple
 
 import requests
@@ -14,7 +12,9 @@ import systemlogger
 from pyhap.accessory import Accessory
 from pyhap.const import CATEGORY_SENSOR
 
+from diagralhomekit.characteristics import CharacteristicUpdate
 from diagralhomekit.plugin import HomekitPlugin
+from diagralhomekit.scheduler import ScheduledTask
 from diagralhomekit.utils import RegexValidator, str_or_none
 
 logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
@@ -84,7 +84,9 @@ class PlexAccount:
         self.server_token = server_token
         self.plex_sensors_data: List[Dict[str, Optional[str]]] = []
         self.plex_sensors: List[PlexActivitySensor] = []
-        self.is_running = True
+        # requests are run by the shared scheduler, so they must never hang
+        self.http_connect_timeout = 10.0
+        self.http_read_timeout = 30.0
 
     def __str__(self):
         """Return a string."""
@@ -92,35 +94,31 @@ class PlexAccount:
 
     def get_api_result(self, endpoint: str):
         """Request the plex server API."""
-        r = requests.get(
-            self.server_url + endpoint,
-            headers={"Accept": "application/json", "X-Plex-Token": self.server_token},
-        )
+        api_metrics = self.config.api_metrics
+        with api_metrics.measure("plex", self.server_url, endpoint) as call:
+            r = requests.get(
+                self.server_url + endpoint,
+                headers={"Accept": "application/json", "X-Plex-Token": self.server_token},
+                timeout=(self.http_connect_timeout, self.http_read_timeout),
+            )
+            call.status = r.status_code
         return r.json()["MediaContainer"]
 
     def extra_log_data(self, **kwargs):
         """Extra data for logging events."""
         return {"tags": {"identifier": self.server_url, "type": "plex", **kwargs}}
 
-    def sleep_while_run(self, interval_in_s: int):
-        """Sleep for the given interval if active."""
-        for __ in range(interval_in_s * 10):
-            if not self.is_running:
-                return
-            time.sleep(0.1)
-
-    def run(self):
-        """Continuously update the systems and looks for alarms."""
+    def update(self):
+        """Update the sensors, called by the scheduler."""
         extra = self.extra_log_data()
-        while self.is_running:
-            logger.debug(f"Update Plex data for {self.server_url}", extra=extra)
-            try:
-                self.update_all_sensors()
-            except Exception as e:
-                logger.exception(e)
+        logger.debug(f"Update Plex data for {self.server_url}", extra=extra)
+        try:
+            self.update_all_sensors()
+        except Exception as e:
+            logger.exception(e)
+            with CharacteristicUpdate() as update:
                 for sensor in self.plex_sensors:
-                    sensor.status_fault.set_value(1)
-            self.sleep_while_run(10)
+                    update.set(sensor.status_fault, 1)
 
     def get_server_info(self):
         """Return main server data."""
@@ -151,20 +149,22 @@ class PlexAccount:
                     sensor.is_active = True
                 elif player["address"] == sensor.selected_player_address:
                     sensor.is_active = True
-        for sensor in self.plex_sensors:
-            sensor.set_characteristics()
-            sensor.occupancy_detected.set_value(1 if sensor.is_active else 0)
-            if sensor.is_active != sensor.previous_state:
-                logger.info(
-                    f"State changed for {sensor.display_name}: {sensor.is_active}"
-                )
-            sensor.status_fault.set_value(0)
+        with CharacteristicUpdate() as update:
+            for sensor in self.plex_sensors:
+                sensor.set_characteristics()
+                update.set(sensor.occupancy_detected, 1 if sensor.is_active else 0)
+                if sensor.is_active != sensor.previous_state:
+                    logger.info(
+                        f"State changed for {sensor.display_name}: {sensor.is_active}"
+                    )
+                update.set(sensor.status_fault, 0)
 
 
 class PlexHomekitPlugin(HomekitPlugin):
     """Plugin for plex servers."""
 
     config_prefix = "plex"
+    update_interval_in_s = 10
     plex_requirements = {
         "server_url": str,
         "server_token": str,
@@ -179,7 +179,7 @@ class PlexHomekitPlugin(HomekitPlugin):
         """init function."""
         super().__init__(config)
         self.plex_accounts: [Tuple[str, str], PlexAccount] = {}
-        self.thread_pool = None
+        self.tasks: List[ScheduledTask] = []
 
     def get_account(self, server_url: str, server_token: str) -> PlexAccount:
         """Get an account identified by the login and the password."""
@@ -216,16 +216,21 @@ class PlexHomekitPlugin(HomekitPlugin):
         return config_errors
 
     def run_all(self):
-        """Run all daemons in separate threads."""
-        if self.plex_accounts:
-            self.thread_pool = ThreadPool(len(self.plex_accounts))
-            for account in self.plex_accounts.values():
-                self.thread_pool.apply_async(account.run)
+        """Update all accounts at regular intervals."""
+        for account in self.plex_accounts.values():
+            task = self.config.scheduler.schedule(
+                account.update,
+                self.update_interval_in_s,
+                jitter_in_s=1,
+                name=str(account),
+            )
+            self.tasks.append(task)
 
     def stop_all(self):
         """Stop all accounts."""
-        for account in self.plex_accounts.values():
-            account.is_running = False
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
 
     def load_accessories(self, bridge):
         """Add accessories to the Homekit bridge."""
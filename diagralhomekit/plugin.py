@@ -29,6 +29,10 @@ class HomekitPlugin:
         """Stop all accounts."""
         pass
 
+    def join_all(self, timeout_in_s: float):
+        """Wait for the end of all daemons, until the timeout."""
+        pass
+
     def load_accessories(self, bridge):
         """Add accessories to the Homekit bridge."""
         raise NotImplementedError
@@ -47,14 +51,12 @@ class HomekitPlugin:
         return {}
 
     def prometheus_write(self, values: Iterable[tuple[str, float, dict[str, str]]]):
-        """Write Prometheus metrics."""
-        if not self.prometheus_filename:
-            return
-        with open(self.prometheus_filename, "w") as fd:
-            for key, value in self.prometheus_metrics_type.items():
-                fd.write(f"# TYPE {key} {value}\n")
-            for key, value in self.prometheus_metrics_help.items():
-                fd.write(f"# HELP {key} {value}\n")
-            for value_data in values:
-                labels = "{" + " ".join([f'{k}="{v}"' for k, v in value_data[2].items()]) + "}"
-                fd.write(f"{value_data[0]}{labels} {value_data[1]}\n")
+        """Write Prometheus metrics.
+
+        Values are merged with the ones of other plugins and accessories using the
+        same file, which is written shortly after. They are also served by the
+        HTTP exporter, even without file.
+        """
+        metrics = self.config.metrics
+        metrics.describe(self.prometheus_metrics_type, self.prometheus_metrics_help)
+        metrics.update(self.prometheus_filename or None, values)
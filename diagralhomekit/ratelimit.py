@@ -0,0 +1,167 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file ratelimit.py is part of DiagralHomekit.                           #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Keep API calls under the limits of the remote service, commands first."""
+import collections
+import contextlib
+import time
+from threading import Condition, Lock, get_ident
+from typing import Callable, Counter, Deque, Optional, Tuple
+
+# user commands may use the whole budget, background polls must leave a reserve
+PRIORITY_COMMAND = 0
+PRIORITY_POLL = 1
+
+
+class TokenBucket:
+    """Allow `capacity` calls per `window_in_s`, with a reserve for commands.
+
+    Tokens are continuously refilled. Calls with the `PRIORITY_POLL` priority cannot
+    use the last `reserve` tokens, so user commands remain possible when background
+    polls exhaust the budget.
+    Each call is also counted by endpoint, for knowing which code path uses the budget.
+    """
+
+    def __init__(self, capacity: int, window_in_s: float, reserve: int = 0):
+        """init function."""
+        self.capacity = capacity
+        self.window_in_s = window_in_s
+        self.reserve = min(reserve, capacity - 1)
+        self.tokens = float(capacity)
+        self.last_refill = time.monotonic()
+        self.lock = Lock()
+        self.total_calls: Counter[str] = collections.Counter()
+        self.recent_calls: Deque[Tuple[float, str]] = collections.deque()
+
+    @property
+    def rate(self) -> float:
+        """Return the number of tokens added each second."""
+        return self.capacity / self.window_in_s
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last_refill) * self.rate
+        )
+        self.last_refill = now
+        while self.recent_calls and self.recent_calls[0][0] < now - self.window_in_s:
+            self.recent_calls.popleft()
+
+    def try_acquire(self, endpoint: str, priority: int = PRIORITY_POLL) -> float:
+        """Try to use a token.
+
+        Return 0 if the call is allowed, or the delay before it can be tried again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            required = 1 + (self.reserve if priority == PRIORITY_POLL else 0)
+            if self.tokens < required:
+                return (required - self.tokens) / self.rate
+            self.tokens -= 1
+            self.total_calls[endpoint] += 1
+            self.recent_calls.append((now, endpoint))
+            return 0.0
+
+    def acquire(
+        self,
+        endpoint: str,
+        priority: int = PRIORITY_POLL,
+        sleep: Callable[[float], None] = time.sleep,
+        is_running: Callable[[], bool] = lambda: True,
+    ) -> bool:
+        """Wait until the call is allowed; return False if stopped while waiting."""
+        while True:
+            delay = self.try_acquire(endpoint, priority=priority)
+            if delay == 0:
+                return True
+            if not is_running():
+                return False
+            sleep(delay)
+
+    def get_usage(self) -> Counter[str]:
+        """Return the number of calls per endpoint during the current window."""
+        with self.lock:
+            self._refill(time.monotonic())
+            return collections.Counter(endpoint for __, endpoint in self.recent_calls)
+
+
+class PriorityLock:
+    """Lock that is always granted to the waiter with the highest priority.
+
+    A thread holding the lock for a long task (like a poll of all systems) calls
+    `yield_if_needed()` between two requests, letting waiting commands go first,
+    and releases it with `released()` while waiting for the API budget.
+    """
+
+    def __init__(self):
+        """init function."""
+        self.condition = Condition()
+        self.owner: Optional[int] = None
+        self.owner_priority = PRIORITY_POLL
+        self.waiters: Counter[int] = collections.Counter()
+
+    def _has_waiter_before(self, priority: int) -> bool:
+        return any(count for p, count in self.waiters.items() if p < priority)
+
+    def acquire(self, priority: int = PRIORITY_POLL):
+        """Wait for the lock."""
+        with self.condition:
+            self.waiters[priority] += 1
+            try:
+                while self.owner is not None or self._has_waiter_before(priority):
+                    self.condition.wait()
+            finally:
+                self.waiters[priority] -= 1
+            self.owner = get_ident()
+            self.owner_priority = priority
+
+    def release(self):
+        """Release the lock."""
+        with self.condition:
+            self.owner = None
+            self.condition.notify_all()
+
+    def yield_if_needed(self):
+        """Let higher-priority waiters go first, if the current thread holds the lock."""
+        with self.condition:
+            if self.owner != get_ident():
+                return
+            priority = self.owner_priority
+            if not self._has_waiter_before(priority):
+                return
+        self.release()
+        self.acquire(priority)
+
+    @contextlib.contextmanager
+    def released(self):
+        """Let other threads take the lock, if held by the current thread."""
+        with self.condition:
+            is_owner = self.owner == get_ident()
+            priority = self.owner_priority
+        if not is_owner:
+            yield
+            return
+        self.release()
+        try:
+            yield
+        finally:
+            self.acquire(priority)
+
+    @contextlib.contextmanager
+    def hold(self, priority: int = PRIORITY_POLL):
+        """Hold the lock with the given priority."""
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def __enter__(self):
+        """Hold the lock with the background priority."""
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Release the lock."""
+        self.release()
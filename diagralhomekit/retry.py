@@ -0,0 +1,162 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file retry.py is part of DiagralHomekit.                               #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Retry failed API calls, with exponential backoff and a circuit breaker."""
+import random
+import time
+from threading import Lock
+from typing import Callable, Optional
+
+import systemlogger
+from requests.exceptions import RequestException
+
+logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
+
+
+class RetryableError(ValueError):
+    """A call failed, but can be tried again."""
+
+    def __init__(
+        self,
+        message: str,
+        cooldown_in_s: Optional[float] = None,
+        immediate: bool = False,
+    ):
+        """init function.
+
+        :param cooldown_in_s: the remote service asks to wait before any new call
+        :param immediate: the call can be tried again without any delay
+        """
+        super().__init__(message)
+        self.cooldown_in_s = cooldown_in_s
+        self.immediate = immediate
+
+
+class CircuitOpenError(ValueError):
+    """The remote service is considered as unavailable."""
+
+
+class CircuitBreaker:
+    """Fail fast while a remote service is down.
+
+    The circuit opens after `failure_threshold` consecutive failures (or when the
+    service explicitly asks for a cooldown) and closes again after a successful call
+    made once `reset_timeout_in_s` has elapsed.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout_in_s: float = 60
+    ):
+        """init function."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_in_s = reset_timeout_in_s
+        self.failures = 0
+        self.opened_until: Optional[float] = None
+        self.lock = Lock()
+
+    @property
+    def state(self) -> str:
+        """Return the current state of the circuit."""
+        if self.opened_until is None:
+            return self.CLOSED
+        if time.monotonic() < self.opened_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def check(self):
+        """Raise an exception if the service must not be called."""
+        if self.state == self.OPEN:
+            remaining = self.opened_until - time.monotonic()
+            raise CircuitOpenError(
+                f"{self.name} is unavailable, no call for {remaining:.0f} seconds."
+            )
+
+    def record_success(self):
+        """A call succeeded."""
+        with self.lock:
+            if self.opened_until is not None:
+                logger.info(f"{self.name} is available again.")
+            self.failures = 0
+            self.opened_until = None
+
+    def record_failure(self):
+        """A call failed."""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._open(self.reset_timeout_in_s)
+
+    def trip(self, cooldown_in_s: float):
+        """Open the circuit for the given duration."""
+        with self.lock:
+            self._open(cooldown_in_s)
+
+    def _open(self, duration_in_s: float):
+        logger.warning(f"{self.name} is unavailable for {duration_in_s:.0f} seconds.")
+        self.opened_until = time.monotonic() + duration_in_s
+
+
+class RetryPolicy:
+    """Retry a function with exponential backoff and full jitter."""
+
+    def __init__(
+        self,
+        max_tries: int = 3,
+        base_delay_in_s: float = 2,
+        max_delay_in_s: float = 30,
+    ):
+        """init function."""
+        self.max_tries = max_tries
+        self.base_delay_in_s = base_delay_in_s
+        self.max_delay_in_s = max_delay_in_s
+
+    def get_delay(self, attempt: int) -> float:
+        """Return a random delay before the given retry (starting at 0)."""
+        return random.uniform(  # nosec
+            0, min(self.max_delay_in_s, self.base_delay_in_s * 2**attempt)
+        )
+
+    def call(
+        self,
+        func: Callable,
+        sleep: Callable[[float], None] = time.sleep,
+        breaker: Optional[CircuitBreaker] = None,
+        error_message: str = "Too many failed tries.",
+        on_retry: Optional[Callable[[], None]] = None,
+    ):
+        """Call the function until it succeeds.
+
+        A `RetryableError` requiring a cooldown opens the circuit breaker (if any)
+        instead of waiting, so the caller does not block for the whole cooldown.
+        `on_retry` is called before each new try.
+        """
+        for attempt in range(self.max_tries):
+            if breaker is not None:
+                breaker.check()
+            try:
+                return func()
+            except RetryableError as e:
+                if e.cooldown_in_s is not None:
+                    if breaker is None:
+                        raise
+                    breaker.trip(e.cooldown_in_s)
+                    raise CircuitOpenError(str(e)) from e
+                if e.immediate:
+                    if on_retry is not None and attempt + 1 < self.max_tries:
+                        on_retry()
+                    continue
+                logger.info(f"{e} (try {attempt + 1}/{self.max_tries})")
+            except RequestException as e:
+                logger.info(f"{e} (try {attempt + 1}/{self.max_tries})")
+            if attempt + 1 < self.max_tries:
+                if on_retry is not None:
+                    on_retry()
+                sleep(self.get_delay(attempt))
+        raise ValueError(error_message)
@@ -0,0 +1,195 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file scheduler.py is part of DiagralHomekit.                           #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Run the periodic work of all plugins on a small pool of threads."""
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import systemlogger
+
+logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "homekit", "application": "homekit"})
+
+
+class ScheduledTask:
+    """A function called again and again by the scheduler.
+
+    The function can return the delay before its next call; the interval of the
+    task is used when it returns None.
+    """
+
+    def __init__(
+        self,
+        scheduler: "Scheduler",
+        func: Callable[[], Optional[float]],
+        interval_in_s: float,
+        jitter_in_s: float = 0.0,
+        name: str = "",
+    ):
+        """init function."""
+        self.scheduler = scheduler
+        self.func = func
+        self.interval_in_s = interval_in_s
+        self.jitter_in_s = jitter_in_s
+        self.name = name or getattr(func, "__qualname__", repr(func))
+        # monotonic time of the next call, None while running or when cancelled
+        self.deadline: Optional[float] = None
+        # earlier call requested while running
+        self.wake_at: Optional[float] = None
+        self.in_progress = False
+        self.is_cancelled = False
+
+    def __str__(self):
+        """Return a string."""
+        return f"ScheduledTask('{self.name}')"
+
+    def get_delay(self, delay_in_s: Optional[float] = None) -> float:
+        """Return the delay before the next call, with some random jitter."""
+        if delay_in_s is None:
+            delay_in_s = self.interval_in_s
+        if self.jitter_in_s:
+            delay_in_s += random.uniform(0, self.jitter_in_s)  # nosec
+        return max(0.0, delay_in_s)
+
+    def run_before(self, delay_in_s: float):
+        """Call the function within the given delay, if not already planned sooner."""
+        self.scheduler.run_before(self, delay_in_s)
+
+    def cancel(self):
+        """Never call the function again."""
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    """Call tasks when they are due, on a bounded pool of worker threads.
+
+    Tasks are stored in a heap sorted by deadline. Idle workers sleep until the
+    first deadline and are only woken earlier by a new task or on shutdown.
+    A task is never run by two workers at the same time.
+
+    >>> scheduler = Scheduler(max_workers=1)
+    >>> done = threading.Event()
+    >>> task = scheduler.schedule(done.set, 3600)
+    >>> scheduler.start()
+    >>> done.wait(5)
+    True
+    >>> scheduler.stop()
+    """
+
+    def __init__(self, max_workers: int = 4):
+        """init function."""
+        self.max_workers = max_workers
+        self.condition = threading.Condition()
+        # (deadline, order, task); entries whose deadline is not the one of their
+        # task are outdated and skipped
+        self.queue: List[Tuple[float, int, ScheduledTask]] = []
+        self.counter = itertools.count()
+        self.workers: List[threading.Thread] = []
+        self.is_running = False
+
+    def schedule(
+        self,
+        func: Callable[[], Optional[float]],
+        interval_in_s: float,
+        delay_in_s: float = 0.0,
+        jitter_in_s: float = 0.0,
+        name: str = "",
+    ) -> ScheduledTask:
+        """Call the function after the delay, then at each interval."""
+        task = ScheduledTask(self, func, interval_in_s, jitter_in_s, name=name)
+        with self.condition:
+            self.push(task, time.monotonic() + task.get_delay(delay_in_s))
+        return task
+
+    def push(self, task: ScheduledTask, deadline: float):
+        """Plan the next call of a task; the condition must be held."""
+        task.deadline = deadline
+        heapq.heappush(self.queue, (deadline, next(self.counter), task))
+        self.condition.notify()
+
+    def run_before(self, task: ScheduledTask, delay_in_s: float):
+        """Move the next call of the task sooner."""
+        deadline = time.monotonic() + max(0.0, delay_in_s)
+        with self.condition:
+            if task.is_cancelled:
+                return
+            if task.in_progress:
+                if task.wake_at is None or deadline < task.wake_at:
+                    task.wake_at = deadline
+            elif task.deadline is None or deadline < task.deadline:
+                self.push(task, deadline)
+
+    def cancel(self, task: ScheduledTask):
+        """Remove the task, without waiting for its current call."""
+        with self.condition:
+            task.is_cancelled = True
+            task.deadline = None
+
+    def start(self):
+        """Start the worker threads."""
+        with self.condition:
+            if self.is_running:
+                return
+            self.is_running = True
+        for index in range(self.max_workers):
+            worker = threading.Thread(
+                target=self.work, name=f"scheduler-{index}", daemon=True
+            )
+            self.workers.append(worker)
+            worker.start()
+
+    def stop(self, timeout_in_s: float = 10.0):
+        """Stop the workers, waiting for the running tasks until the timeout."""
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        end = time.monotonic() + timeout_in_s
+        for worker in self.workers:
+            worker.join(max(0.0, end - time.monotonic()))
+        self.workers = []
+
+    def get_next_task(self) -> Optional[ScheduledTask]:
+        """Wait for the first due task; return None on shutdown."""
+        with self.condition:
+            while self.is_running:
+                while self.queue and self.queue[0][2].deadline != self.queue[0][0]:
+                    heapq.heappop(self.queue)
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                deadline, __, task = self.queue[0]
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heapq.heappop(self.queue)
+                task.deadline = None
+                task.in_progress = True
+                return task
+        return None
+
+    def work(self):
+        """Run the due tasks until the shutdown."""
+        while True:
+            task = self.get_next_task()
+            if task is None:
+                return
+            delay_in_s = None
+            try:
+                delay_in_s = task.func()
+            except Exception as e:
+                logger.exception(e, extra={"tags": {"type": "scheduler"}})
+            with self.condition:
+                task.in_progress = False
+                if task.is_cancelled:
+                    continue
+                deadline = time.monotonic() + task.get_delay(delay_in_s)
+                if task.wake_at is not None:
+                    deadline = min(deadline, task.wake_at)
+                    task.wake_at = None
+                self.push(task, deadline)
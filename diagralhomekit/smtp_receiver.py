@@ -0,0 +1,165 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file smtp_receiver.py is part of DiagralHomekit.                       #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Minimal SMTP/LMTP server, receiving the alarm emails forwarded by a local MTA."""
+import socketserver
+import threading
+import time
+from typing import Callable, List, Optional
+
+import systemlogger
+
+logger = systemlogger.getLogger(__name__, extra_tags={"application_fqdn": "alarm", "application": "homekit"})
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    """Handle a single SMTP (or LMTP) connection.
+
+    Only the headers of received messages are kept and given to the handlers of the
+    server; messages are always accepted, since they cannot be delivered elsewhere.
+    """
+
+    server: "SmtpReceiver"
+    timeout = 300
+
+    def write(self, line: str):
+        """Send a line to the client."""
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def readline(self) -> Optional[bytes]:
+        """Read a line, without its end; return None when the connection is closed."""
+        line = self.rfile.readline(self.server.max_line_length + 2)
+        if not line:
+            return None
+        return line.rstrip(b"\r\n")
+
+    def handle(self):
+        """Process all commands."""
+        server = self.server
+        self.write(f"220 {server.hostname} {server.protocol} diagralhomekit ready")
+        recipients: List[str] = []
+        sender: Optional[str] = None
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            command, __, args = line.decode(errors="replace").partition(" ")
+            command = command.upper()
+            if command in ("HELO", "EHLO", "LHLO"):
+                if (command == "LHLO") != server.lmtp:
+                    self.write(f"500 5.5.1 {command} is not supported")
+                    continue
+                if command == "HELO":
+                    self.write(f"250 {server.hostname}")
+                else:
+                    self.write(f"250-{server.hostname}")
+                    self.write("250 8BITMIME")
+                sender, recipients = None, []
+            elif command == "MAIL":
+                sender, recipients = args, []
+                self.write("250 2.1.0 OK")
+            elif command == "RCPT":
+                if sender is None:
+                    self.write("503 5.5.1 MAIL first")
+                    continue
+                recipients.append(args)
+                self.write("250 2.1.5 OK")
+            elif command == "DATA":
+                if not recipients:
+                    self.write("503 5.5.1 RCPT first")
+                    continue
+                self.write("354 End data with <CR><LF>.<CR><LF>")
+                header = self.read_data()
+                if header is None:
+                    return
+                server.dispatch(header)
+                # LMTP requires a reply for each recipient
+                for __ in recipients if server.lmtp else [None]:
+                    self.write("250 2.0.0 OK")
+                sender, recipients = None, []
+            elif command == "RSET":
+                sender, recipients = None, []
+                self.write("250 2.0.0 OK")
+            elif command == "NOOP":
+                self.write("250 2.0.0 OK")
+            elif command == "QUIT":
+                self.write("221 2.0.0 Bye")
+                return
+            else:
+                self.write("502 5.5.2 Command not implemented")
+
+    def read_data(self) -> Optional[bytes]:
+        """Read a message until the final dot, returning its headers."""
+        lines = []
+        in_header = True
+        while True:
+            line = self.readline()
+            if line is None:
+                return None
+            if line == b".":
+                break
+            if not in_header:
+                continue
+            if line == b"":
+                in_header = False
+                continue
+            if line.startswith(b"."):
+                line = line[1:]
+            lines.append(line)
+        return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+class SmtpReceiver(socketserver.ThreadingTCPServer):
+    """Receive emails and give their headers to all subscribed handlers."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+    max_line_length = 8192
+
+    def __init__(self, address: str = "127.0.0.1", port: int = 8025, lmtp: bool = False):
+        """init function."""
+        super().__init__((address, port), SmtpHandler)
+        self.lmtp = lmtp
+        self.protocol = "LMTP" if lmtp else "ESMTP"
+        self.hostname = address
+        self.handlers: List[Callable[[bytes, float], None]] = []
+        self.thread: Optional[threading.Thread] = None
+
+    def __str__(self):
+        """Return a string."""
+        return f"{self.protocol} {self.server_address[0]}:{self.server_address[1]}"
+
+    @property
+    def port(self) -> int:
+        """Return the listening port."""
+        return self.server_address[1]
+
+    def subscribe(self, handler: Callable[[bytes, float], None]):
+        """Call the handler with the headers and the reception time of each message."""
+        if handler not in self.handlers:
+            self.handlers.append(handler)
+
+    def dispatch(self, header: bytes):
+        """Give the headers of a received message to all handlers."""
+        received_at = time.time()
+        for handler in self.handlers:
+            try:
+                handler(header, received_at)
+            except Exception as e:
+                logger.exception(e)
+
+    def start(self):
+        """Start listening in a separate thread."""
+        logger.info(f"Listening for alarm emails on {self}.")
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop listening."""
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
@@ -0,0 +1,99 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file subjects.py is part of DiagralHomekit.                            #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Find the alarm system and the kind of event announced by a notification email."""
+import re
+from typing import Dict, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+EVENT_ALARM = "alarm"
+EVENT_INTRUSION = "intrusion"
+EVENT_FAULT = "fault"
+EVENT_TAMPER = "tamper"
+
+# last word of the subject ("[Diagral] Home : Alarme"), in all known languages
+EVENT_WORDS = {
+    "alarme": EVENT_ALARM,
+    "alarm": EVENT_ALARM,
+    "allarme": EVENT_ALARM,
+    "alarma": EVENT_ALARM,
+    "intrusion": EVENT_INTRUSION,
+    "intrusione": EVENT_INTRUSION,
+    "intrusión": EVENT_INTRUSION,
+    "einbruch": EVENT_INTRUSION,
+    "défaut": EVENT_FAULT,
+    "defaut": EVENT_FAULT,
+    "panne": EVENT_FAULT,
+    "fault": EVENT_FAULT,
+    "guasto": EVENT_FAULT,
+    "störung": EVENT_FAULT,
+    "fallo": EVENT_FAULT,
+    "sabotage": EVENT_TAMPER,
+    "autoprotection": EVENT_TAMPER,
+    "tamper": EVENT_TAMPER,
+    "manomissione": EVENT_TAMPER,
+}
+SUBJECT_PATTERN = re.compile(
+    r"^(?P<name>.*?)\s*:\s*(?P<event>%s)\s*$"
+    % "|".join(re.escape(x) for x in sorted(EVENT_WORDS, key=len, reverse=True)),
+    re.IGNORECASE,
+)
+# the system name can be preceded by any text, like "[Diagral]"
+WORD_START = re.compile(r"(?<=[\s\]])\S")
+
+T = TypeVar("T")
+
+
+def parse_subject(subject: str) -> Optional[Tuple[str, str]]:
+    """Return the system name and the kind of event given in an email subject.
+
+    >>> parse_subject("[Diagral] Home : Alarme")
+    ('[Diagral] Home', 'alarm')
+    >>> parse_subject("Maison: Sabotage")
+    ('Maison', 'tamper')
+    >>> parse_subject("Your weekly newsletter") is None
+    True
+    """
+    matcher = SUBJECT_PATTERN.match(subject.strip())
+    if not matcher:
+        return None
+    return matcher.group("name"), EVENT_WORDS[matcher.group("event").lower()]
+
+
+class SubjectIndex(Generic[T]):
+    """Map the subjects of notification emails to the concerned systems.
+
+    Built once for all systems, so a subject is classified with a few dict lookups
+    (one for each word of the text before the event), whatever the number of systems.
+
+    >>> index = SubjectIndex([("Home", 1), ("* Office", 2), ("Other Home", 3)])
+    >>> index.classify("[Diagral] Home : Alarme")
+    ('alarm', [1])
+    >>> index.classify("[Diagral] Other Home : Intrusion")
+    ('intrusion', [3, 1])
+    >>> index.classify("Office : Défaut")
+    ('fault', [2])
+    >>> index.classify("Home-2 : Alarme")
+    ('alarm', [])
+    """
+
+    def __init__(self, names: Iterable[Tuple[str, T]]):
+        """init function."""
+        self.systems: Dict[str, List[T]] = {}
+        for name, system in names:
+            if name.startswith("* "):
+                name = name[2:]
+            self.systems.setdefault(name, []).append(system)
+
+    def classify(self, subject: str) -> Optional[Tuple[str, List[T]]]:
+        """Return the kind of event and the concerned systems, or None for other emails."""
+        parsed = parse_subject(subject)
+        if parsed is None:
+            return None
+        text, event = parsed
+        # a name is matched by the end of the text, so all word suffixes are tried
+        systems = list(self.systems.get(text, []))
+        for matcher in WORD_START.finditer(text):
+            systems += self.systems.get(text[matcher.start() :], [])
+        return event, systems
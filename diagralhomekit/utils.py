@@ -4,7 +4,11 @@
 #  Please check the LICENSE file for sharing or distribution permissions.      #
 # ##############################################################################
 """Some utility functions."""
+import email.message
+import email.parser
+import email.policy
 import re
+import threading
 import unicodedata
 from typing import Optional
 
@@ -40,6 +44,37 @@ def str_or_none(value: str) -> Optional[str]:
     return value or None
 
 
+def parse_email_headers(content: bytes) -> email.message.EmailMessage:
+    r"""Parse the headers of a raw email, ignoring its body.
+
+    Folded and RFC 2047 encoded headers are decoded.
+
+    >>> headers = b"Subject: =?utf-8?q?D=C3=A9faut?=\r\n Home : Alarme\r\n\r\n"
+    >>> str(parse_email_headers(headers)["Subject"])
+    'Défaut Home : Alarme'
+    """
+    parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+    return parser.parsebytes(content)
+
+
+def get_email_timestamp(message: email.message.EmailMessage) -> Optional[float]:
+    r"""Return the timestamp given by the Date header of an email, if valid.
+
+    >>> headers = b"Date: Mon, 03 Jul 2023 12:34:56 +0200\r\n\r\n"
+    >>> get_email_timestamp(parse_email_headers(headers))
+    1688380496.0
+    >>> get_email_timestamp(parse_email_headers(b"Date: yesterday\r\n\r\n")) is None
+    True
+    """
+    try:
+        date = message["Date"]
+        if date is None or date.datetime is None:
+            return None
+        return date.datetime.timestamp()
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
 def capture_some_exception(e):
     """Silently discards some network exceptions."""
     if isinstance(
@@ -84,3 +119,68 @@ def bool_validator(value: str) -> bool:
     :return:
     """
     return value and value.lower() in {"yes", "true", "1", "on"}
+
+
+class BackoffInterval:
+    """Polling interval that doubles each time nothing happens.
+
+    >>> interval = BackoffInterval(10, 60)
+    >>> [interval.next(active=False) for __ in range(4)]
+    [10, 20, 40, 60]
+    >>> interval.next(active=True)
+    10
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, factor: float = 2):
+        """init function."""
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.current = min_interval
+
+    def reset(self):
+        """Go back to the shortest interval."""
+        self.current = self.min_interval
+
+    def next(self, active: bool):
+        """Return the next interval, resetting it if there is some activity."""
+        if active:
+            self.reset()
+        value = self.current
+        self.current = min(self.max_interval, self.current * self.factor)
+        return value
+
+
+class RunningState:
+    """Running flag whose waits end as soon as it is stopped.
+
+    >>> state = RunningState()
+    >>> state.wait(0.01)
+    True
+    >>> state.stop()
+    >>> state.wait(3600)
+    False
+    >>> state.is_running
+    False
+    """
+
+    def __init__(self):
+        """init function."""
+        self.stopped = threading.Event()
+
+    @property
+    def is_running(self) -> bool:
+        """Return True until stopped."""
+        return not self.stopped.is_set()
+
+    def start(self):
+        """Allow new waits."""
+        self.stopped.clear()
+
+    def stop(self):
+        """End all current and future waits."""
+        self.stopped.set()
+
+    def wait(self, timeout_in_s: float) -> bool:
+        """Wait for the timeout; return False if stopped before its end."""
+        return not self.stopped.wait(max(0.0, timeout_in_s))
@@ -0,0 +1,319 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file imap_server.py is part of DiagralHomekit.                         #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Minimal local IMAP server, only implementing what is used by diagralhomekit."""
+import re
+import socketserver
+import threading
+from typing import List, Optional
+
+MESSAGE_TEMPLATE = (
+    "From: Diagral <noreply@diagral.fr>\r\n"
+    "To: alarm@example.com\r\n"
+    "Date: Mon, 03 Jul 2023 12:34:56 +0200\r\n"
+    "Subject: {subject}\r\n"
+    "Content-Type: text/plain; charset=utf-8\r\n"
+    "\r\n"
+    "{body}\r\n"
+)
+
+
+class Message:
+    """An email stored in the fake mailbox."""
+
+    def __init__(self, uid: int, content: bytes):
+        """init function."""
+        self.uid = uid
+        self.content = content
+        self.flags = set()
+
+
+class Mailbox:
+    """Content of the fake mailbox, shared by all connections."""
+
+    def __init__(self, capabilities=("IDLE",), uid_last: bool = False):
+        """init function."""
+        self.capabilities = list(capabilities)
+        # other mailboxes, where messages can be copied or moved
+        self.directories = ["Archives"]
+        # send the UID after the other FETCH items, as allowed by RFC 3501
+        self.uid_last = uid_last
+        self.messages: List[Message] = []
+        self.uid_validity = 1
+        self.uid_next = 1
+        self.lock = threading.RLock()
+        self.idling: List["ImapHandler"] = []
+        # untagged responses sent in the same packet as the IDLE continuation
+        self.idle_responses: List[str] = []
+        self.commands: List[str] = []
+
+    def add_message(self, subject: str, body: str = "") -> Message:
+        """Add a new message, notifying idling clients."""
+        content = MESSAGE_TEMPLATE.format(subject=subject, body=body).encode()
+        with self.lock:
+            message = Message(self.uid_next, content)
+            self.uid_next += 1
+            self.messages.append(message)
+            for handler in self.idling:
+                handler.write(f"* {len(self.messages)} EXISTS")
+        return message
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    """Handle a single IMAP connection."""
+
+    server: "ImapServer"
+
+    def write(self, line: str):
+        """Send a line to the client."""
+        self.wfile.write(line.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def write_literal(self, prefix: str, data: bytes, suffix: str = ")"):
+        """Send a response including a literal."""
+        self.wfile.write(f"{prefix} {{{len(data)}}}\r\n".encode() + data)
+        self.wfile.write(suffix.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        """Process all commands."""
+        mailbox = self.server.mailbox
+        self.write("* OK IMAP4rev1 fake server ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode().rstrip("\r\n")
+            tag, __, command = line.partition(" ")
+            name, __, args = command.partition(" ")
+            name = name.upper()
+            with mailbox.lock:
+                mailbox.commands.append(command)
+            if name == "UID":
+                name, __, args = args.partition(" ")
+                name = "UID " + name.upper()
+            method = getattr(self, "do_" + name.replace(" ", "_"), None)
+            if method is None:
+                self.write(f"{tag} BAD unknown command")
+                continue
+            with mailbox.lock:
+                result = method(args)
+            if result is None:
+                self.write(f"{tag} OK {name} completed")
+            elif result == "LOGOUT":
+                self.write(f"{tag} OK LOGOUT completed")
+                return
+            elif result == "IDLE":
+                self.idle(tag)
+            else:
+                self.write(f"{tag} {result}")
+
+    def idle(self, tag: str):
+        """Wait for the end of the IDLE command."""
+        mailbox = self.server.mailbox
+        lines = ["+ idling"] + mailbox.idle_responses
+        self.wfile.write("".join(f"{line}\r\n" for line in lines).encode())
+        self.wfile.flush()
+        with mailbox.lock:
+            mailbox.idling.append(self)
+        line = self.rfile.readline()
+        with mailbox.lock:
+            mailbox.idling.remove(self)
+        if line.strip().upper() == b"DONE":
+            self.write(f"{tag} OK IDLE terminated")
+        else:
+            self.write(f"{tag} BAD expected DONE")
+
+    def do_CAPABILITY(self, args):
+        """List capabilities."""
+        self.write("* CAPABILITY IMAP4rev1 " + " ".join(self.server.mailbox.capabilities))
+
+    def do_LOGIN(self, args):
+        """Accept any login."""
+
+    def do_LOGOUT(self, args):
+        """Close the connection."""
+        self.write("* BYE")
+        return "LOGOUT"
+
+    def do_NOOP(self, args):
+        """Do nothing."""
+
+    def do_SELECT(self, args):
+        """Select the single mailbox."""
+        mailbox = self.server.mailbox
+        self.write(f"* {len(mailbox.messages)} EXISTS")
+        self.write("* 0 RECENT")
+        self.write(f"* OK [UIDVALIDITY {mailbox.uid_validity}] UIDs valid")
+        self.write(f"* OK [UIDNEXT {mailbox.uid_next}] next UID")
+        return "OK [READ-WRITE] SELECT completed"
+
+    def do_IDLE(self, args):
+        """Start waiting for new messages."""
+        if "IDLE" not in self.server.mailbox.capabilities:
+            return "BAD IDLE not supported"
+        return "IDLE"
+
+    def get_messages(self, sequence_set: str, by_uid: bool) -> List[Message]:
+        """Return the messages matching a sequence set."""
+        messages = self.server.mailbox.messages
+        if not messages:
+            return []
+        max_value = messages[-1].uid if by_uid else len(messages)
+        selected = set()
+        for item in sequence_set.split(","):
+            start, __, end = item.partition(":")
+            start = max_value if start == "*" else int(start)
+            end = start if not end else (max_value if end == "*" else int(end))
+            start, end = min(start, end), max(start, end)
+            selected |= set(range(start, end + 1))
+        if by_uid:
+            return [m for m in messages if m.uid in selected]
+        return [m for i, m in enumerate(messages, start=1) if i in selected]
+
+    def search(self, args: str, by_uid: bool):
+        criteria = args.upper()
+        messages = self.server.mailbox.messages
+        result = []
+        for index, message in enumerate(messages, start=1):
+            if "NOT DELETED" in criteria and "\\Deleted" in message.flags:
+                continue
+            result.append(message.uid if by_uid else index)
+        self.write("* SEARCH " + " ".join(str(x) for x in result))
+
+    def do_SEARCH(self, args):
+        """Search messages."""
+        self.search(args, by_uid=False)
+
+    def do_UID_SEARCH(self, args):
+        """Search messages by UID."""
+        self.search(args, by_uid=True)
+
+    def fetch(self, args: str, by_uid: bool):
+        sequence_set, __, items = args.partition(" ")
+        items = items.strip("()").upper()
+        messages = self.server.mailbox.messages
+        for message in self.get_messages(sequence_set, by_uid):
+            index = messages.index(message) + 1
+            parts = []
+            with_uid = by_uid or "UID" in items.split()
+            if with_uid and not self.server.mailbox.uid_last:
+                parts.append(f"UID {message.uid}")
+            if "RFC822.SIZE" in items:
+                parts.append(f"RFC822.SIZE {len(message.content)}")
+            literal: Optional[bytes] = None
+            header, __, __ = message.content.partition(b"\r\n\r\n")
+            matcher = re.search(r"BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]", items)
+            if matcher:
+                names = {x.lower() for x in matcher.group(1).split()}
+                lines = re.split(rb"\r\n(?![ \t])", header)
+                selected = [x for x in lines if x.split(b":")[0].lower().decode() in names]
+                literal = b"\r\n".join(selected) + b"\r\n\r\n"
+                parts.append(f"BODY[HEADER.FIELDS ({matcher.group(1)})]")
+            elif re.search(r"BODY(?:\.PEEK)?\[HEADER\]", items):
+                literal = header + b"\r\n\r\n"
+                parts.append("BODY[HEADER]")
+            elif "RFC822" in items.replace("RFC822.SIZE", "").split():
+                literal = message.content
+                parts.append("RFC822")
+            suffix = ")"
+            if with_uid and self.server.mailbox.uid_last:
+                if literal is None:
+                    parts.append(f"UID {message.uid}")
+                else:
+                    suffix = f" UID {message.uid})"
+            prefix = f"* {index} FETCH (" + " ".join(parts)
+            if literal is None:
+                self.write(prefix + ")")
+            else:
+                self.write_literal(prefix, literal, suffix=suffix)
+
+    def do_FETCH(self, args):
+        """Fetch messages."""
+        self.fetch(args, by_uid=False)
+
+    def do_UID_FETCH(self, args):
+        """Fetch messages by UID."""
+        self.fetch(args, by_uid=True)
+
+    def store(self, args: str, by_uid: bool):
+        sequence_set, __, flags = args.partition(" ")
+        __, __, flags = flags.partition(" ")
+        for message in self.get_messages(sequence_set, by_uid):
+            message.flags |= set(flags.strip("()").split())
+
+    def do_STORE(self, args):
+        """Add flags to messages."""
+        self.store(args, by_uid=False)
+
+    def do_UID_STORE(self, args):
+        """Add flags to messages by UID."""
+        self.store(args, by_uid=True)
+
+    def expunge(self, uids: Optional[set]):
+        mailbox = self.server.mailbox
+        index = 0
+        while index < len(mailbox.messages):
+            message = mailbox.messages[index]
+            if "\\Deleted" in message.flags and (uids is None or message.uid in uids):
+                del mailbox.messages[index]
+                self.write(f"* {index + 1} EXPUNGE")
+            else:
+                index += 1
+
+    def do_EXPUNGE(self, args):
+        """Remove deleted messages."""
+        self.expunge(None)
+
+    def do_UID_EXPUNGE(self, args):
+        """Remove some deleted messages."""
+        if "UIDPLUS" not in self.server.mailbox.capabilities:
+            return "BAD UIDPLUS not supported"
+        self.expunge({m.uid for m in self.get_messages(args, by_uid=True)})
+
+    def do_UID_MOVE(self, args):
+        """Move messages to another mailbox (they are only removed here)."""
+        if "MOVE" not in self.server.mailbox.capabilities:
+            return "BAD MOVE not supported"
+        sequence_set, __, directory = args.partition(" ")
+        if directory not in self.server.mailbox.directories:
+            return "NO [TRYCREATE] no such mailbox"
+        for message in self.get_messages(sequence_set, by_uid=True):
+            message.flags.add("\\Deleted")
+        self.expunge({m.uid for m in self.get_messages(sequence_set, by_uid=True)})
+
+    def do_UID_COPY(self, args):
+        """Copy messages to another mailbox (nothing is done here)."""
+        __, __, directory = args.partition(" ")
+        if directory not in self.server.mailbox.directories:
+            return "NO [TRYCREATE] no such mailbox"
+
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    """Local IMAP server, listening on a random port."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: Mailbox):
+        """init function."""
+        super().__init__(("127.0.0.1", 0), ImapHandler)
+        self.mailbox = mailbox
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        """Return the listening port."""
+        return self.server_address[1]
+
+    def __enter__(self):
+        """Start the server."""
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        """Stop the server."""
+        self.shutdown()
+        self.server_close()
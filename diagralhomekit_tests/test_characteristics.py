@@ -0,0 +1,66 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_characteristics.py is part of DiagralHomekit.                #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Unittests for batched characteristic updates."""
+import threading
+
+from pyhap.accessory import get_topic
+from pyhap.characteristic import Characteristic
+
+from diagralhomekit.characteristics import CharacteristicUpdate
+
+
+class FakeDriver:
+    """Record the sent events."""
+
+    def __init__(self):
+        """init function."""
+        self.tid = threading.current_thread()
+        self.topics = {}
+        self.events = []
+
+    def async_send_event(self, topic, data, sender_client_addr, immediate):
+        """Record an event."""
+        self.events.append((topic, data["value"], immediate))
+
+
+class FakeIidManager:
+    """Use the type of characteristics as IID."""
+
+    @staticmethod
+    def get_iid(char):
+        """Return the IID of a characteristic."""
+        return int(char.type_id)
+
+
+class FakeAccessory:
+    """Accessory with two characteristics."""
+
+    def __init__(self, driver, aid):
+        """init function."""
+        self.driver = driver
+        self.aid = aid
+        self.iid_manager = FakeIidManager()
+        self.characteristics = []
+        for iid, name in ((2, "StatusFault"), (3, "SecuritySystemCurrentState")):
+            char = Characteristic(name, str(iid), {"Format": "uint8"})
+            char.broker = self
+            self.characteristics.append(char)
+            driver.topics[get_topic(aid, iid)] = {("127.0.0.1", 1234)}
+
+
+def test_batched_update():
+    """Test that only changes are notified, in a single batch for all accessories."""
+    driver = FakeDriver()
+    accessories = [FakeAccessory(driver, 10), FakeAccessory(driver, 11)]
+    with CharacteristicUpdate() as update:
+        for accessory in accessories:
+            update.set(accessory.characteristics[0], 0)
+            update.set(accessory.characteristics[1], 4)
+    # unchanged values (StatusFault is already 0) are not sent
+    assert driver.events == [("10.3", 4, False), ("11.3", 4, False)]
+    with CharacteristicUpdate() as update:
+        update.set(accessories[0].characteristics[1], 4)
+    assert len(driver.events) == 2
@@ -4,6 +4,7 @@
 #  Please check the LICENSE file for sharing or distribution permissions.      #
 # ##############################################################################
 """Basic unittests."""
+import logging
 from unittest.mock import patch
 
 from diagralhomekit.config import HomekitConfig
@@ -51,3 +52,152 @@ def test_get_central_status():
     system.analyze_central_status(data)
     assert system.status_fault
     account.do_logout()
+
+
+def test_fault_kept_by_central_status():
+    """Test that a fault reported by email is kept while the central reports an alert."""
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    system = account.get_alarm_system(
+        81838,
+        transmitter_id="123456789ABCDE",
+        central_id="123456789ABCF0",
+        master_code=8888,
+        name="Home",
+    )
+    system.status_fault = True
+    system.analyze_central_status({"zoneStatus": {"tamperAlert": True}})
+    assert system.status_fault
+    system.analyze_central_status({"zoneStatus": {"tamperAlert": False}})
+    assert not system.status_fault
+
+
+@patch("diagralhomekit.diagral.DiagralAccount.request", new=request_mock)
+def test_persisted_session(tmp_path):
+    """Test that a persisted session is reused instead of a new login."""
+    config = HomekitConfig()
+    config.config_dir = tmp_path
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    account.session_persist = True
+    account.ensure_login()
+    assert account.session_id == "eyJhbGciOiJFUzI1NiIsInR5cCI6Ik"
+    account.end_session()
+    assert account.session_id is not None
+
+    # a login with a wrong password would fail: the persisted session is used
+    account = DiagralAccount(config, "diagral@example.com", "wrong")
+    account.session_persist = True
+    account.ensure_login()
+    assert account.session_id == "eyJhbGciOiJFUzI1NiIsInR5cCI6Ik"
+
+
+def test_keep_ttm_session():
+    """Test that the TTM session is reused between two updates."""
+    endpoints = []
+
+    def counting_request_mock(mock, endpoint, json_data=None, method="POST"):
+        endpoints.append(endpoint)
+        return request_mock(mock, endpoint, json_data=json_data, method=method)
+
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    account.is_running = False
+    account.get_alarm_system(
+        81838,
+        transmitter_id="123456789ABCDE",
+        central_id="123456789ABCF0",
+        master_code=8888,
+        name="Home",
+    )
+    with patch("diagralhomekit.diagral.DiagralAccount.request", new=counting_request_mock):
+        account.update_all_systems()
+        account.update_all_systems()
+    assert endpoints.count("/authenticate/login") == 1
+    assert endpoints.count("/authenticate/connect") == 1
+    assert endpoints.count("/status/getSystemState") == 2
+    assert endpoints.count("/configuration/getCentralStatusZone") == 1
+
+
+@patch("diagralhomekit.diagral.DiagralAccount.request", new=request_mock)
+def test_optimistic_updates():
+    """Test that the accepted state is only shown with optimistic updates."""
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    system = account.get_alarm_system(
+        81838,
+        transmitter_id="123456789ABCDE",
+        central_id="123456789ABCF0",
+        master_code=8888,
+        name="Home",
+    )
+    system.ttm_session_id = "123456789abcdefdabb43a003094ea780"
+    account.optimistic_updates = False
+    system.send_activation_command({1, 2})
+    # shown once returned by the next poll
+    assert system.get_active_groups() == set()
+    account.optimistic_updates = True
+    system.send_activation_command({1, 2})
+    assert system.get_active_groups() == {1, 2}
+
+
+def test_rejected_session():
+    """Test that a rejected session leads to a single new login and retry."""
+    calls = []
+
+    class FakeResponse:
+        def __init__(self, status_code, content=None):
+            self.status_code = status_code
+            self.content = content
+
+        def json(self):
+            return self.content
+
+    class FakeSession:
+        headers = {}
+
+        def request(self, method, url, **kwargs):
+            calls.append(url)
+            if url.endswith("/authenticate/login"):
+                return FakeResponse(200, {"sessionId": "new-session"})
+            return FakeResponse(401)
+
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    account.http_session = FakeSession()
+    account.session_id = "old-session"
+    r = account.request("/status/getSystemState", json_data={})
+    assert r.status_code == 401
+    assert [url.rpartition("/topaze")[2] for url in calls] == [
+        "/status/getSystemState",
+        "/authenticate/login",
+        "/status/getSystemState",
+    ]
+
+
+def test_budget_interval():
+    """Test that armed systems are never polled more often than the API budget allows."""
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    for system_id in (1, 2):
+        system = account.get_alarm_system(
+            system_id,
+            transmitter_id="123456789ABCDE",
+            central_id="123456789ABCF0",
+            master_code=8888,
+            name=f"System {system_id}",
+        )
+        system.set_active_groups({1})
+    polls = account.api_budget_window / account.get_next_poll_interval()
+    # one request for each system, and complete statuses every 10 minutes
+    calls = polls * 2 + 2 * account.api_budget_window / account.full_status_interval
+    assert calls <= account.api_budget - account.api_reserve
+    assert account.get_next_poll_interval() > account.poll_min_interval
+
+
+def test_logged_sleep(caplog):
+    """Test that a logged sleep has a valid log message."""
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    with caplog.at_level(logging.INFO, logger="diagralhomekit.diagral"):
+        account.sleep_while_run(0, log=True)
+    assert [x.getMessage() for x in caplog.records] == ["Sleeping for 0 seconds"]
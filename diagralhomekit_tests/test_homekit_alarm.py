@@ -0,0 +1,173 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_homekit_alarm.py is part of DiagralHomekit.                  #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Unittests for the Homekit alarm accessory."""
+from threading import Event
+from unittest.mock import MagicMock
+
+# noinspection PyPackageRequirements
+from pyhap.loader import get_loader
+
+from diagralhomekit.alarm_system import AlarmSystem
+from diagralhomekit.config import HomekitConfig
+from diagralhomekit.homekit_alarm import AlarmCommandQueue, HomekitAlarm
+from diagralhomekit.plugin import HomekitPlugin
+
+
+class FakeAlarmSystem(AlarmSystem):
+    """Alarm system that blocks on its first command."""
+
+    identifier = 42
+
+    def __init__(self):
+        """init function."""
+        super().__init__("fake")
+        self.sent_groups = []
+        self.first_command_received = Event()
+        self.unblock = Event()
+
+    def activate_groups(self, groups):
+        """Record the command."""
+        self.first_command_received.set()
+        self.unblock.wait(5)
+        self.sent_groups.append(groups)
+        self.set_active_groups(groups)
+
+
+def test_command_queue():
+    """Test that pending commands are coalesced and useless ones are skipped."""
+    system = FakeAlarmSystem()
+    results = []
+    done = Event()
+
+    def callback(state, error):
+        results.append((state, error))
+        if len(results) == 2:
+            done.set()
+
+    queue = AlarmCommandQueue(system, callback)
+    queue.submit(1, {1, 2})
+    system.first_command_received.wait(5)
+    # only the last one is kept, and skipped since it is already active
+    queue.submit(2, {1})
+    queue.submit(3, set())
+    queue.submit(1, {1, 2})
+    system.unblock.set()
+    assert done.wait(5)
+    assert system.sent_groups == [{1, 2}]
+    assert results == [(1, None), (1, None)]
+
+
+def test_outdated_groups():
+    """Test that a command is sent when the known groups may be outdated."""
+    system = FakeAlarmSystem()
+    system.unblock.set()
+    system.set_active_groups({1})
+    system.groups_updated_at -= system.groups_max_age_in_s
+    done = Event()
+    queue = AlarmCommandQueue(system, lambda state, error: done.set())
+    # the system may have been armed or disarmed on the keypad since
+    queue.submit(1, {1})
+    assert done.wait(5)
+    assert system.sent_groups == [{1}]
+
+
+class OptimisticAlarmSystem(AlarmSystem):
+    """Alarm system that accepts commands but never applies them."""
+
+    identifier = 43
+    optimistic_updates = True
+
+    def activate_groups(self, groups):
+        """Accept the command."""
+
+    def confirm_groups(self, groups):
+        """The new state is never reached."""
+        return False
+
+
+def test_change_events():
+    """Test that listeners are called once for each actual change."""
+    system = OptimisticAlarmSystem("events")
+    events = []
+    system.add_listener(lambda: events.append(system.get_active_groups()))
+    system.set_active_groups({1})
+    system.set_active_groups({1})
+    system.is_triggered = True
+    system.is_triggered = True
+    system.status_fault = True
+    # disarming also clears the triggered state, with a single event
+    system.set_active_groups(set())
+    assert events == [{1}, {1}, {1}, set()]
+    assert not system.is_triggered
+
+
+class DisplayedAlarmSystem(OptimisticAlarmSystem):
+    """Alarm system that can be displayed in Homekit."""
+
+    serial_number = "43"
+
+    def get_stay_groups(self):
+        """Return the groups of the stay mode."""
+        return {1}
+
+    def get_night_groups(self):
+        """Return the groups of the night mode."""
+        return {2}
+
+
+def test_command_fault_cleared():
+    """Test that the fault of a failed command is cleared by the next poll."""
+    system = DisplayedAlarmSystem("displayed")
+    driver = MagicMock()
+    driver.loader = get_loader()
+    accessory = HomekitAlarm(HomekitPlugin(HomekitConfig()), system, driver)
+    accessory.command_done(HomekitAlarm.STATE_AWAY_ARM, ValueError("timeout"))
+    assert accessory.alarm_status_fault.get_value() == 1
+    accessory.update_state()
+    assert accessory.alarm_status_fault.get_value() == 1
+    system.set_active_groups(set())
+    accessory.update_state()
+    assert accessory.alarm_status_fault.get_value() == 0
+
+
+class RolledBackAlarmSystem(DisplayedAlarmSystem):
+    """Alarm system that accepts commands, but whose state is then restored."""
+
+    identifier = 44
+
+    def activate_groups(self, groups):
+        """Accept the command, as the reply of the alarm system."""
+        self.set_active_groups(groups)
+
+    def confirm_groups(self, groups):
+        """The next status shows the previous state."""
+        self.set_active_groups(set())
+        return False
+
+
+def test_optimistic_command():
+    """Test that the state is shown before being confirmed, and then rolled back."""
+    system = RolledBackAlarmSystem("rolled back")
+    driver = MagicMock()
+    driver.loader = get_loader()
+    accessory = HomekitAlarm(HomekitPlugin(HomekitConfig()), system, driver)
+    shown = []
+    system.add_listener(
+        lambda: shown.append(accessory.alarm_current_state.get_value())
+    )
+    done = Event()
+
+    def callback(state, error):
+        accessory.command_done(state, error)
+        done.set()
+
+    accessory.command_queue.callback = callback
+    accessory.set_target_state(HomekitAlarm.STATE_AWAY_ARM)
+    assert done.wait(5)
+    assert shown == [HomekitAlarm.STATE_AWAY_ARM, HomekitAlarm.STATE_DISARMED]
+    assert accessory.alarm_current_state.get_value() == HomekitAlarm.STATE_DISARMED
+    assert accessory.alarm_target_state.get_value() == HomekitAlarm.STATE_DISARMED
+    assert accessory.alarm_status_fault.get_value() == 1
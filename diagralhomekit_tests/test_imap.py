@@ -0,0 +1,253 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_imap.py is part of DiagralHomekit.                           #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Check alarm emails against a local IMAP server."""
+import imaplib
+import threading
+import time
+
+import pytest
+
+from diagralhomekit.config import HomekitConfig
+from diagralhomekit.diagral import DiagralAccount
+from diagralhomekit.imap import ImapMailbox, idle, supports_idle
+from diagralhomekit_tests.imap_server import ImapServer, Mailbox
+
+
+def get_account(port: int) -> DiagralAccount:
+    """Return an account using the local IMAP server."""
+    config = HomekitConfig()
+    account = DiagralAccount(config, "diagral@example.com", "p4ssw0rD")
+    account.imap_login = "alarm@example.com"
+    account.imap_password = "imap_p4ssw0rD"
+    account.imap_hostname = "127.0.0.1"
+    account.imap_port = port
+    account.imap_use_tls = False
+    # no request to the Diagral API
+    account.next_status_update = time.monotonic() + 3600
+    system = account.get_alarm_system(
+        81838,
+        transmitter_id="123456789ABCDE",
+        central_id="123456789ABCF0",
+        master_code=8888,
+        name="Home",
+    )
+    system.internal_name = "Home"
+    return account
+
+
+def test_idle():
+    """Test that IDLE returns as soon as a message is received."""
+    mailbox = Mailbox()
+    with ImapServer(mailbox) as server:
+        with imaplib.IMAP4("127.0.0.1", server.port) as imap_client:
+            imap_client.login("alarm@example.com", "imap_p4ssw0rD")
+            imap_client.select()
+            assert supports_idle(imap_client)
+            assert not idle(imap_client, 0.2)
+            timer = threading.Timer(0.2, mailbox.add_message, args=("Home : Alarme",))
+            timer.start()
+            start = time.monotonic()
+            assert idle(imap_client, 10)
+            assert time.monotonic() - start < 5
+            imap_client.noop()
+
+
+def test_idle_buffered_response():
+    """Test that a response received with the IDLE continuation is not delayed."""
+    mailbox = Mailbox()
+    mailbox.idle_responses = ["* 1 EXISTS"]
+    with ImapServer(mailbox) as server:
+        with imaplib.IMAP4("127.0.0.1", server.port) as imap_client:
+            imap_client.login("alarm@example.com", "imap_p4ssw0rD")
+            imap_client.select()
+            start = time.monotonic()
+            assert idle(imap_client, 5)
+            assert time.monotonic() - start < 2
+            imap_client.noop()
+
+
+def test_check_alarm_emails():
+    """Test that an alarm email triggers the alarm, with or without IDLE."""
+    for capabilities in (("IDLE",), ()):
+        mailbox = Mailbox(capabilities=capabilities)
+        mailbox.add_message("Home-2 : Alarme")
+        mailbox.add_message("[Diagral] Home : Alarme")
+        with ImapServer(mailbox) as server:
+            account = get_account(server.port)
+            account.check_alarm_emails(check_interval_in_s=0)
+            account.close_mailbox()
+        system = account.alarm_systems[81838]
+        assert system.is_triggered
+        assert not mailbox.messages
+        # sent at the Date of the email, then received and matched
+        timing = system.trigger_timing
+        assert timing.sent_at == 1688380496.0
+        assert timing.sent_at < timing.received_at <= timing.matched_at
+
+
+def test_uid_after_header():
+    """Test that messages are read and deleted when the UID follows the header."""
+    mailbox = Mailbox(uid_last=True)
+    mailbox.add_message("Newsletter")
+    mailbox.add_message("Home : Alarme")
+    with ImapServer(mailbox) as server:
+        account = get_account(server.port)
+        account.check_alarm_emails(check_interval_in_s=0)
+        assert account.get_mailbox().last_uid == 2
+        account.close_mailbox()
+    assert account.alarm_systems[81838].is_triggered
+    assert not mailbox.messages
+
+
+def test_incremental_fetch():
+    """Test that only new messages are fetched, with a single command."""
+    mailbox = Mailbox()
+    for index in range(5):
+        mailbox.add_message(f"Newsletter {index}")
+    with ImapServer(mailbox) as server:
+        account = get_account(server.port)
+        account.check_alarm_emails(check_interval_in_s=0)
+        assert account.get_mailbox().last_uid == 5
+        mailbox.add_message("Home : Alarme")
+        mailbox.commands.clear()
+        account.check_alarm_emails(check_interval_in_s=0)
+        account.close_mailbox()
+    fetch_commands = [x for x in mailbox.commands if "FETCH" in x.upper()]
+    assert len(fetch_commands) == 1
+    assert fetch_commands[0].startswith("UID FETCH 6:*")
+    assert account.alarm_systems[81838].is_triggered
+
+
+def test_encoded_subject():
+    """Test that only headers are fetched, and that encoded subjects are decoded."""
+    mailbox = Mailbox()
+    mailbox.add_message("=?utf-8?q?=5BDiagral=5D_Home?=\r\n : Alarme", body="x" * 100000)
+    with ImapServer(mailbox) as server:
+        account = get_account(server.port)
+        account.check_alarm_emails(check_interval_in_s=0)
+        account.close_mailbox()
+    fetch_commands = [x for x in mailbox.commands if "FETCH" in x.upper()]
+    assert "BODY.PEEK[HEADER.FIELDS (SUBJECT DATE FROM)]" in fetch_commands[0]
+    assert account.alarm_systems[81838].is_triggered
+
+
+def test_shared_mailbox():
+    """Test that a single connection is kept and shared by accounts using the same mailbox."""
+    mailbox = Mailbox()
+    with ImapServer(mailbox) as server:
+        account_1 = get_account(server.port)
+        account_2 = get_account(server.port)
+        account_1.check_alarm_emails(check_interval_in_s=0)
+        assert account_1.get_mailbox() is account_2.get_mailbox()
+        mailbox.add_message("Home : Alarme")
+        account_1.check_alarm_emails(check_interval_in_s=0)
+        assert account_2.alarm_systems[81838].is_triggered
+        assert len([x for x in mailbox.commands if x.startswith("LOGIN")]) == 1
+        # the connection is closed by the last account
+        imap_mailbox = account_1.get_mailbox()
+        account_1.close_mailbox()
+        assert imap_mailbox.client is not None
+        account_2.close_mailbox()
+        assert imap_mailbox.client is None
+
+
+def test_subscribe_during_idle():
+    """Test that an account can share the mailbox while another one is idling."""
+    mailbox = Mailbox()
+    with ImapServer(mailbox) as server:
+        account_1 = get_account(server.port)
+        account_2 = get_account(server.port)
+        account_1.check_alarm_emails(check_interval_in_s=0)
+        thread = threading.Thread(
+            target=account_1.check_alarm_emails, kwargs={"check_interval_in_s": 3}
+        )
+        thread.start()
+        while not mailbox.idling:
+            time.sleep(0.01)
+        start = time.monotonic()
+        account_2.get_mailbox()
+        account_2.close_mailbox()
+        assert time.monotonic() - start < 1
+        thread.join()
+        account_1.close_mailbox()
+
+
+def test_reconnect():
+    """Test that a lost connection is opened again."""
+    mailbox = Mailbox(capabilities=())
+    with ImapServer(mailbox) as server:
+        account = get_account(server.port)
+        account.check_alarm_emails(check_interval_in_s=0)
+        imap_mailbox: ImapMailbox = account.get_mailbox()
+        imap_mailbox.client.shutdown()
+        try:
+            account.check_alarm_emails(check_interval_in_s=0)
+        except (imaplib.IMAP4.error, OSError, ValueError):
+            pass
+        mailbox.add_message("Home : Alarme")
+        account.check_alarm_emails(check_interval_in_s=0)
+        account.close_mailbox()
+    assert account.alarm_systems[81838].is_triggered
+    assert len([x for x in mailbox.commands if x.startswith("LOGIN")]) == 2
+
+
+def test_fault_email():
+    """Test that a tamper email sets the fault status and requires a complete status."""
+    mailbox = Mailbox()
+    mailbox.add_message("[Diagral] Home : Sabotage")
+    with ImapServer(mailbox) as server:
+        account = get_account(server.port)
+        system = account.alarm_systems[81838]
+        system.last_full_status_update = time.monotonic()
+        account.check_alarm_emails(check_interval_in_s=0)
+        account.close_mailbox()
+    assert system.status_fault
+    assert not system.is_triggered
+    assert system.is_full_status_due(account.full_status_interval)
+
+
+def test_batched_removal():
+    """Test that processed messages are removed (or archived) with a few commands."""
+    for capabilities, archive, expected in (
+        ((), "", ["UID STORE 1:3 +FLAGS (\\Deleted)", "EXPUNGE"]),
+        (
+            ("UIDPLUS",),
+            "",
+            ["UID STORE 1:3 +FLAGS (\\Deleted)", "UID EXPUNGE 1:3"],
+        ),
+        (("MOVE",), "Archives", ["UID MOVE 1:3 Archives"]),
+        (
+            (),
+            "Archives",
+            ["UID COPY 1:3 Archives", "UID STORE 1:3 +FLAGS (\\Deleted)", "EXPUNGE"],
+        ),
+    ):
+        mailbox = Mailbox(capabilities=capabilities)
+        for index in range(3):
+            mailbox.add_message(f"Newsletter {index}")
+        with ImapServer(mailbox) as server:
+            account = get_account(server.port)
+            account.imap_archive_directory = archive
+            account.check_alarm_emails(check_interval_in_s=0)
+            account.close_mailbox()
+        assert not mailbox.messages
+        index = next(i for i, x in enumerate(mailbox.commands) if "FETCH" in x)
+        assert mailbox.commands[index + 1 : index + 1 + len(expected)] == expected
+
+
+def test_failed_archive():
+    """Test that messages are kept when they cannot be archived."""
+    for capabilities in (("MOVE",), ()):
+        mailbox = Mailbox(capabilities=capabilities)
+        mailbox.add_message("Newsletter")
+        with ImapServer(mailbox) as server:
+            account = get_account(server.port)
+            account.imap_archive_directory = "Missing"
+            with pytest.raises(ValueError):
+                account.check_alarm_emails(check_interval_in_s=0)
+            account.close_mailbox()
+        assert len(mailbox.messages) == 1
+        assert not any("STORE" in x for x in mailbox.commands)
@@ -0,0 +1,134 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_metrics.py is part of DiagralHomekit.                        #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Unittests for the Prometheus metrics registry."""
+import signal
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+
+# noinspection PyPackageRequirements
+from pyhap.loader import get_loader
+
+from diagralhomekit.config import HomekitConfig
+from diagralhomekit.exporter import MetricsExporter
+from diagralhomekit.main import run_daemons
+from diagralhomekit.plex import PlexAccount
+
+
+def test_merged_metrics(tmp_path):
+    """Test that the values of all plugins are merged in a single file."""
+    filename = str(tmp_path / "homekit.prom")
+    config = HomekitConfig()
+    diagral, plex = config.plugins[:2]
+    diagral.prometheus_filename = filename
+    plex.prometheus_filename = filename
+    diagral.prometheus_write([("homekit_alarm_state", 1, {"application_fqdn": "Home"})])
+    diagral.prometheus_write([("homekit_alarm_state", 3, {"application_fqdn": "Office"})])
+    plex.prometheus_write([("homekit_plex", 1, {})])
+    diagral.prometheus_write([("homekit_alarm_state", 0, {"application_fqdn": "Home"})])
+    config.metrics.flush()
+    assert (tmp_path / "homekit.prom").read_text() == (
+        "# TYPE homekit_alarm_state gauge\n"
+        'homekit_alarm_state{application_fqdn="Home"} 0\n'
+        'homekit_alarm_state{application_fqdn="Office"} 3\n'
+        "homekit_plex 1\n"
+    )
+    # no temporary file is left
+    assert [x.name for x in tmp_path.iterdir()] == ["homekit.prom"]
+
+
+def test_exporter():
+    """Test that metrics are rendered on each request, in both formats."""
+    config = HomekitConfig()
+    plugin = config.plugins[0]
+    plugin.prometheus_write([("homekit_alarm_state", 1, {"application_fqdn": "Home"})])
+    exporter = MetricsExporter(config.metrics, 0, address="127.0.0.1")
+    exporter.start()
+    try:
+        url = f"http://127.0.0.1:{exporter.port}/metrics"
+        r = requests.get(url)
+        assert r.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert 'homekit_alarm_state{application_fqdn="Home"} 1\n' in r.text
+        plugin.prometheus_write([("homekit_alarm_state", 4, {"application_fqdn": "Home"})])
+        r = requests.get(url, headers={"Accept": "application/openmetrics-text"})
+        assert r.headers["Content-Type"].startswith("application/openmetrics-text")
+        assert 'homekit_alarm_state{application_fqdn="Home"} 4\n' in r.text
+        assert r.text.endswith("# EOF\n")
+        assert requests.get(f"http://127.0.0.1:{exporter.port}/").status_code == 404
+    finally:
+        exporter.stop()
+
+
+def test_exporter_stopped_after_error(tmp_path):
+    """Test that the exporter port is released when the Homekit driver fails."""
+    (tmp_path / "config.ini").write_text("")
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        port = sock.getsockname()[1]
+    driver = MagicMock()
+    driver.loader = get_loader()
+    driver.start.side_effect = RuntimeError("Homekit port already in use")
+    handler = signal.getsignal(signal.SIGTERM)
+    try:
+        with patch("diagralhomekit.main.AccessoryDriver", return_value=driver):
+            with pytest.raises(RuntimeError):
+                run_daemons(tmp_path, 51826, metrics_port=port)
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+    # the next try can listen on the same port
+    MetricsExporter(HomekitConfig().metrics, port).stop()
+
+
+class PlexHandler(BaseHTTPRequestHandler):
+    """Answer all requests with an empty Plex result."""
+
+    def do_GET(self):
+        """Return an empty result."""
+        content = b'{"MediaContainer": {}}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """No log."""
+
+
+def test_api_metrics():
+    """Test that API calls are measured, with their errors."""
+    config = HomekitConfig()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PlexHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    account = PlexAccount(config, url, "token")
+    try:
+        account.get_api_result("status/sessions")
+        account.get_api_result("status/sessions")
+    finally:
+        server.shutdown()
+        server.server_close()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        account.get_api_result("status/sessions")
+    # a server that never answers cannot block a worker of the scheduler
+    with socket.socket() as hung:
+        hung.bind(("127.0.0.1", 0))
+        hung.listen()
+        hung_url = f"http://127.0.0.1:{hung.getsockname()[1]}/"
+        hung_account = PlexAccount(config, hung_url, "token")
+        hung_account.http_read_timeout = 0.2
+        with pytest.raises(requests.exceptions.Timeout):
+            hung_account.get_api_result("status/sessions")
+    labels = f'{{plugin="plex",account="{url}",endpoint="status/sessions"'
+    content = config.metrics.render()
+    assert f'homekit_api_requests_total{labels},status="200"}} 2\n' in content
+    assert f'homekit_api_errors_total{labels},error="connection"}} 1\n' in content
+    assert f"homekit_api_request_duration_seconds_count{labels}}} 3\n" in content
+    hung_labels = f'{{plugin="plex",account="{hung_url}",endpoint="status/sessions"'
+    assert f'homekit_api_errors_total{hung_labels},error="timeout"}} 1\n' in content
@@ -0,0 +1,73 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_ratelimit.py is part of DiagralHomekit.                      #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Unittests for the API rate limiter."""
+import time
+from threading import Event, Thread
+
+from diagralhomekit.ratelimit import (
+    PRIORITY_COMMAND,
+    PRIORITY_POLL,
+    PriorityLock,
+    TokenBucket,
+)
+
+
+def test_token_bucket():
+    """Test that polls leave a reserve for user commands."""
+    bucket = TokenBucket(capacity=5, window_in_s=3600, reserve=2)
+    for __ in range(3):
+        assert bucket.try_acquire("/status/getSystemState", PRIORITY_POLL) == 0
+    assert bucket.try_acquire("/status/getSystemState", PRIORITY_POLL) > 0
+    assert bucket.try_acquire("/action/stateCommand", PRIORITY_COMMAND) == 0
+    assert bucket.try_acquire("/action/stateCommand", PRIORITY_COMMAND) == 0
+    assert bucket.try_acquire("/action/stateCommand", PRIORITY_COMMAND) > 0
+    assert bucket.get_usage() == {
+        "/status/getSystemState": 3,
+        "/action/stateCommand": 2,
+    }
+
+
+def test_priority_lock():
+    """Test that a command preempts a poll at the next request boundary."""
+    lock = PriorityLock()
+    events = []
+
+    def command():
+        with lock.hold(PRIORITY_COMMAND):
+            events.append("command")
+
+    with lock:
+        thread = Thread(target=command)
+        thread.start()
+        while not lock.waiters[PRIORITY_COMMAND]:
+            time.sleep(0.01)
+        events.append("request 1")
+        lock.yield_if_needed()
+        events.append("request 2")
+    thread.join()
+    assert events == ["request 1", "command", "request 2"]
+
+
+def test_released_lock():
+    """Test that a command is not delayed by a poll waiting for the API budget."""
+    lock = PriorityLock()
+    events = []
+    waiting = Event()
+
+    def command():
+        waiting.wait(5)
+        with lock.hold(PRIORITY_COMMAND):
+            events.append("command")
+
+    thread = Thread(target=command)
+    thread.start()
+    with lock:
+        with lock.released():
+            waiting.set()
+            thread.join(5)
+            events.append("budget")
+        events.append("request")
+    assert events == ["command", "budget", "request"]
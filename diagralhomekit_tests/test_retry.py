@@ -0,0 +1,60 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_retry.py is part of DiagralHomekit.                          #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Unittests for the retry policy and the circuit breaker."""
+import pytest
+
+from diagralhomekit.retry import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryableError,
+    RetryPolicy,
+)
+
+
+def test_retry_policy():
+    """Test that temporary errors are retried with bounded delays."""
+    delays = []
+    results = [RetryableError("first"), RetryableError("second"), 42]
+
+    def func():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    policy = RetryPolicy(max_tries=3, base_delay_in_s=2, max_delay_in_s=3)
+    retries = []
+    assert policy.call(func, sleep=delays.append, on_retry=lambda: retries.append(1)) == 42
+    assert len(delays) == 2
+    assert len(retries) == 2
+    assert 0 <= delays[0] <= 2
+    assert 0 <= delays[1] <= 3
+
+    def always_fail():
+        raise RetryableError("failed")
+
+    with pytest.raises(ValueError, match="Too many"):
+        policy.call(always_fail, sleep=delays.append)
+
+
+def test_circuit_breaker():
+    """Test that the circuit opens after failures or a cooldown request."""
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout_in_s=60)
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    def overlimit():
+        raise RetryableError("overlimit", cooldown_in_s=180)
+
+    with pytest.raises(CircuitOpenError):
+        RetryPolicy().call(overlimit, sleep=lambda x: None, breaker=breaker)
+    assert breaker.state == CircuitBreaker.OPEN
@@ -0,0 +1,109 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_scheduler.py is part of DiagralHomekit.                      #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Check the scheduler shared by all plugins."""
+import threading
+import time
+
+from diagralhomekit.config import HomekitConfig
+from diagralhomekit.scheduler import Scheduler
+
+
+def test_periodic_tasks():
+    """Test intervals, delays returned by tasks, early wake-ups and cancellation."""
+    scheduler = Scheduler(max_workers=2)
+    fast_calls = []
+    slow_calls = []
+    fast = scheduler.schedule(lambda: fast_calls.append(time.monotonic()), 0.05)
+    # the returned delay replaces the interval of the task
+    slow = scheduler.schedule(lambda: slow_calls.append(time.monotonic()) or 3600, 1)
+    scheduler.start()
+    try:
+        time.sleep(0.5)
+        assert len(fast_calls) >= 4
+        assert len(slow_calls) == 1
+        slow.run_before(0)
+        time.sleep(0.2)
+        assert len(slow_calls) == 2
+        fast.cancel()
+        time.sleep(0.1)
+        count = len(fast_calls)
+        time.sleep(0.2)
+        assert len(fast_calls) == count
+    finally:
+        scheduler.stop()
+    assert not scheduler.workers
+
+
+def test_bounded_workers():
+    """Test that tasks never use more threads than the pool and stop quickly."""
+    scheduler = Scheduler(max_workers=2)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+    done = threading.Event()
+
+    def task():
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        done.set()
+
+    for __ in range(5):
+        scheduler.schedule(task, 3600, jitter_in_s=0.01)
+    scheduler.start()
+    assert done.wait(5)
+    time.sleep(0.3)
+    start = time.monotonic()
+    scheduler.stop()
+    assert time.monotonic() - start < 1
+    assert max_running[0] == 2
+
+
+def test_stop_all():
+    """Test that stopping interrupts long sleeps and joins all threads at once."""
+    config = HomekitConfig()
+    plugin = config.plugins[0]
+    account = plugin.get_account("diagral@example.com", "p4ssw0rD")
+    sleeping = threading.Event()
+
+    def poll():
+        sleeping.set()
+        account.sleep_while_run(3600)
+
+    account.poll = poll
+    config.run_all()
+    assert sleeping.wait(5)
+    start = time.monotonic()
+    config.stop_all()
+    assert time.monotonic() - start < 1
+    assert not config.scheduler.workers
+    assert not account.is_running
+
+
+def test_failed_initialization():
+    """Test that a failed login is tried again less and less often."""
+    config = HomekitConfig()
+    account = config.plugins[0].get_account("diagral@example.com", "wrong")
+    account.poll_min_interval = 0.1
+    account.poll_max_interval = 10
+    logins = []
+
+    def ensure_login():
+        logins.append(time.monotonic())
+        raise ValueError("Invalid login")
+
+    account.ensure_login = ensure_login
+    config.run_all()
+    try:
+        time.sleep(1.0)
+    finally:
+        config.stop_all()
+    # tried after 0, 0.1, 0.3 and 0.7 seconds
+    assert 3 <= len(logins) <= 4
+    assert not account.is_initialized
@@ -0,0 +1,57 @@
+# ##############################################################################
+#  Copyright (c) Matthieu Gallet <github@19pouces.net> 2023.                   #
+#  This file test_smtp_receiver.py is part of DiagralHomekit.                  #
+#  Please check the LICENSE file for sharing or distribution permissions.      #
+# ##############################################################################
+"""Receive alarm emails with the local SMTP/LMTP listener."""
+import smtplib
+import socket
+
+import pytest
+
+from diagralhomekit.config import HomekitConfig
+from diagralhomekit.smtp_receiver import SmtpReceiver
+from diagralhomekit_tests.imap_server import MESSAGE_TEMPLATE
+from diagralhomekit_tests.test_imap import get_account
+
+
+def test_smtp_receiver():
+    """Test that an alarm email sent by SMTP or LMTP immediately triggers the alarm."""
+    for lmtp in (False, True):
+        account = get_account(0)
+        receiver = SmtpReceiver("127.0.0.1", 0, lmtp=lmtp)
+        receiver.subscribe(account.analyze_email)
+        receiver.start()
+        try:
+            cls = smtplib.LMTP if lmtp else smtplib.SMTP
+            with cls("127.0.0.1", receiver.port) as client:
+                for subject in ("Newsletter", "[Diagral] Home : Alarme"):
+                    content = MESSAGE_TEMPLATE.format(subject=subject, body=".\r\nx")
+                    refused = client.sendmail(
+                        "noreply@diagral.fr", ["alarm@example.com"], content
+                    )
+                    assert not refused
+        finally:
+            receiver.stop()
+        assert account.alarm_systems[81838].is_triggered
+
+
+def test_stopped_after_error():
+    """Test that listeners are closed when another one cannot listen."""
+    config = HomekitConfig()
+    plugin = config.plugins[0]
+    with socket.socket() as used, socket.socket() as free:
+        used.bind(("127.0.0.1", 0))
+        used.listen()
+        free.bind(("127.0.0.1", 0))
+        ports = free.getsockname()[1], used.getsockname()[1]
+        free.close()
+        for index, port in enumerate(ports):
+            account = plugin.get_account(f"diagral{index}@example.com", "p4ssw0rD")
+            account.smtp_port = port
+        with pytest.raises(OSError):
+            config.run_all()
+        config.stop_all()
+    assert not plugin.smtp_receivers
+    # the next try can listen on the same port
+    SmtpReceiver("127.0.0.1", ports[0]).stop()